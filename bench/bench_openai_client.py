@@ -0,0 +1,102 @@
+"""Compare per-turn LLM latency with a fresh AsyncOpenAI per turn against the pooled client.
+
+Starts bench/stub_openrouter.py in a subprocess and streams the same completion
+through both paths:
+
+    python bench/bench_openai_client.py --turns 200 --users 4 --output bench_output.txt
+
+"fresh" is the old behaviour (new client and connection pool on every turn);
+"pooled" goes through app.use_openai_client. Against the plain-HTTP stub the
+difference is TCP setup and client construction; against OpenRouter a TLS
+handshake is added on top.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import time
+
+import stub_openrouter
+from common import percentile, start_server, use_app
+
+
+def summarize(latencies, elapsed):
+    return {
+        "turns": len(latencies),
+        "turns_per_second": len(latencies) / elapsed,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+async def stream_turn(client):
+    stream = await client.chat.completions.create(
+        model="stub/model",
+        messages=[{"role": "user", "content": "hello"}],
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    async for _ in stream:
+        pass
+
+
+async def run_mode(mode, turns, users, base_url):
+    import openai
+    import app
+
+    latencies = []
+
+    async def user(index):
+        api_key = f"sk-bench-{index}"
+        for _ in range(turns // users):
+            started = time.perf_counter()
+            if mode == "fresh":
+                client = openai.AsyncOpenAI(base_url=base_url, api_key=api_key)
+                try:
+                    await stream_turn(client)
+                finally:
+                    await client.close()
+            else:
+                async with app.use_openai_client(api_key) as client:
+                    await stream_turn(client)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(i) for i in range(users)))
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI client pooling benchmark")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--tokens", type=int, default=20)
+    parser.add_argument("--token-delay-ms", type=float, default=0.0)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    base_url = f"http://127.0.0.1:{args.port}"
+    use_app(OPENROUTER_BASE_URL=base_url)
+    server = start_server(stub_openrouter.serve, args.port, tokens=args.tokens, token_delay_ms=args.token_delay_ms)
+    try:
+        results = {
+            "benchmark": "openai_client",
+            "config": vars(args),
+            "fresh": asyncio.run(run_mode("fresh", args.turns, args.users, base_url)),
+            "pooled": asyncio.run(run_mode("pooled", args.turns, args.users, base_url)),
+        }
+    finally:
+        server.terminate()
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Measure the per-call cost of validating tool arguments against their input schema.
+
+Compiles a representative MCP tool schema once with app.compile_schema and
+times validating valid and invalid arguments, next to parsing the argument
+string (which every call already pays) and, when the jsonschema package is
+installed, a prebuilt jsonschema validator for the same schema:
+
+    python bench/bench_schema_validation.py --calls 100000
+
+The numbers are microseconds per call, to compare with the MCP round trip
+an invalid call would otherwise cost.
+"""
+import argparse
+import json
+import time
+
+from common import use_app
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "sql": {"type": "string"},
+        "database": {"type": "string", "enum": ["main", "staging", "archive"]},
+        "limit": {"type": "integer"},
+        "timeout": {"type": "number"},
+        "columns": {"type": "array", "items": {"type": "string"}},
+        "options": {
+            "type": "object",
+            "properties": {"explain": {"type": "boolean"}, "tag": {"type": ["string", "null"]}},
+            "additionalProperties": False,
+        },
+    },
+    "required": ["sql", "database"],
+    "additionalProperties": False,
+}
+
+VALID = {
+    "sql": "select name, revenue from companies where year = 2024",
+    "database": "main",
+    "limit": 100,
+    "timeout": 2.5,
+    "columns": ["name", "revenue", "year", "segment"],
+    "options": {"explain": False, "tag": None},
+}
+
+INVALID = {
+    "query": "select 1",
+    "database": "prod",
+    "limit": "100",
+    "columns": ["name", 3],
+    "options": {"explain": "no", "extra": 1},
+}
+
+
+def per_call_us(func, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return round((time.perf_counter() - started) / calls * 1e6, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tool argument validation benchmark")
+    parser.add_argument("--calls", type=int, default=100000)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    use_app()
+    import app
+
+    validate = app.compile_schema(SCHEMA)
+    assert validate(VALID) == []
+    arguments = json.dumps(VALID)
+
+    results = {
+        "benchmark": "schema_validation",
+        "config": vars(args),
+        "invalid_errors": len(validate(INVALID)),
+        "compile_us": per_call_us(lambda: app.compile_schema(SCHEMA), max(1, args.calls // 100)),
+        "json_loads_us": per_call_us(lambda: json.loads(arguments), args.calls),
+        "validate_valid_us": per_call_us(lambda: validate(VALID), args.calls),
+        "validate_invalid_us": per_call_us(lambda: validate(INVALID), args.calls),
+    }
+
+    try:
+        import jsonschema
+    except ImportError:
+        jsonschema = None
+    if jsonschema is not None:
+        validator = jsonschema.Draft202012Validator(SCHEMA)
+        results["jsonschema_valid_us"] = per_call_us(lambda: validator.is_valid(VALID), args.calls)
+        results["jsonschema_invalid_us"] = per_call_us(lambda: list(validator.iter_errors(INVALID)), args.calls)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Measure websocket emits per response and event-loop lag for concurrent token streams.
+
+Runs N concurrent streams through a real Chainlit message, each receiving
+tokens at a fixed rate, and counts the stream_token emits they make:
+
+    python bench/bench_stream_writer.py --streams 100 --tokens 1000 --token-delay-ms 1 --burst 20
+
+Tokens arrive --burst at a time, as they do when one network read carries
+several SSE events from a fast model.
+
+"per_token" emits every token as it arrives (the old call_llm behaviour, and
+StreamFlushMs=0 in the settings); "coalesced" uses app.CoalescingStreamWriter
+with the default STREAM_FLUSH_MS and STREAM_FLUSH_CHARS. The emitter JSON-encodes
+each payload, standing in for Socket.IO framing.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+
+from common import percentile, use_app
+from load_test import milliseconds, monitor_loop_lag, noop_emit_call
+
+
+async def stream(index, args, flush_ms, flush_chars, emits):
+    import chainlit as cl
+    from chainlit.context import init_ws_context
+    from chainlit.session import WebsocketSession
+
+    import app
+
+    async def emit(event, data):
+        json.dumps(data, default=str)
+        if event in ("stream_start", "stream_token"):
+            emits[index] += 1
+
+    session = WebsocketSession(
+        id=str(uuid.uuid4()),
+        socket_id=str(uuid.uuid4()),
+        emit=emit,
+        emit_call=noop_emit_call,
+        user_env={},
+        client_type="webapp",
+        thread_id=str(uuid.uuid4()),
+    )
+    init_ws_context(session)
+    try:
+        writer = app.CoalescingStreamWriter(cl.Message(content=""), flush_ms=flush_ms, flush_chars=flush_chars)
+        for i in range(args.tokens):
+            if i % args.burst == 0:
+                await asyncio.sleep(args.token_delay_ms * args.burst / 1000)
+            await writer.write(f"tok{i} ")
+        await writer.flush()
+        assert len(writer.text()) == sum(len(f"tok{i} ") for i in range(args.tokens))
+    finally:
+        await session.delete()
+
+
+async def run_mode(args, flush_ms, flush_chars):
+    lag_samples = []
+    monitor = asyncio.create_task(monitor_loop_lag(lag_samples))
+    emits = [0] * args.streams
+    started = time.perf_counter()
+    await asyncio.gather(*(stream(i, args, flush_ms, flush_chars, emits) for i in range(args.streams)))
+    elapsed = time.perf_counter() - started
+    monitor.cancel()
+    return {
+        "flush_ms": flush_ms,
+        "flush_chars": flush_chars,
+        "elapsed_s": round(elapsed, 3),
+        "emits_per_response": statistics.mean(emits),
+        "event_loop_lag_ms": {
+            "p50": milliseconds(percentile(lag_samples, 0.5)),
+            "p99": milliseconds(percentile(lag_samples, 0.99)),
+            "max": milliseconds(max(lag_samples, default=None)),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream token coalescing benchmark")
+    parser.add_argument("--streams", type=int, default=100)
+    parser.add_argument("--tokens", type=int, default=1000)
+    parser.add_argument("--token-delay-ms", type=float, default=1.0)
+    parser.add_argument("--burst", type=int, default=20)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    use_app()
+    import app
+
+    results = {
+        "benchmark": "stream_writer",
+        "config": vars(args),
+        "per_token": asyncio.run(run_mode(args, 0, 0)),
+        "coalesced": asyncio.run(run_mode(args, app.DEFAULT_STREAM_FLUSH_MS, app.STREAM_FLUSH_CHARS)),
+    }
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Compare tool routing by scanning every connection against the name index.
+
+Builds mcp_tools_data for many connections with many tools each and looks up
+random tool names both ways:
+
+    python bench/bench_tool_index.py --connections 50 --tools-per-connection 100 --lookups 100000
+
+"scan" is the old call_tool behaviour (any() over each connection's tool list on
+every call); "index" is a lookup in the table app.build_tool_index builds once
+per connection change. The build time is reported too, since it is paid on
+every connect and disconnect.
+"""
+import argparse
+import json
+import random
+import time
+
+from common import use_app
+
+
+def make_tools_data(connections, tools_per_connection):
+    return {
+        f"server_{c}": tuple(
+            {"name": f"server_{c}_tool_{t}", "description": "", "input_schema": {"type": "object"}}
+            for t in range(tools_per_connection)
+        )
+        for c in range(connections)
+    }
+
+
+def scan(mcp_tools_data, tool_name):
+    for connection_name, tools in mcp_tools_data.items():
+        if any(tool["name"] == tool_name for tool in tools):
+            return connection_name
+    return None
+
+
+def time_lookups(lookup, names):
+    started = time.perf_counter()
+    for name in names:
+        lookup(name)
+    return (time.perf_counter() - started) / len(names) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tool routing index benchmark")
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--tools-per-connection", type=int, default=100)
+    parser.add_argument("--lookups", type=int, default=100000)
+    parser.add_argument("--builds", type=int, default=100)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    use_app()
+    import app
+
+    mcp_tools_data = make_tools_data(args.connections, args.tools_per_connection)
+    all_names = [tool["name"] for tools in mcp_tools_data.values() for tool in tools]
+    names = random.Random(0).choices(all_names, k=args.lookups)
+    # The scan is slow enough that a sample of the lookups gives a stable figure
+    scan_names = names[:max(1, args.lookups // 100)]
+
+    started = time.perf_counter()
+    for _ in range(args.builds):
+        tool_index, _ = app.build_tool_index(mcp_tools_data)
+    build_ms = (time.perf_counter() - started) / args.builds * 1000
+
+    scan_us = time_lookups(lambda name: scan(mcp_tools_data, name), scan_names)
+    index_us = time_lookups(lambda name: tool_index.get(name), names)
+    results = {
+        "benchmark": "tool_index",
+        "config": vars(args),
+        "tools": len(all_names),
+        "scan_us_per_lookup": round(scan_us, 3),
+        "index_us_per_lookup": round(index_us, 3),
+        "speedup": round(scan_us / index_us, 1),
+        "index_build_ms": round(build_ms, 3),
+    }
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
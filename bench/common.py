@@ -0,0 +1,51 @@
+"""Helpers shared by the benchmark scripts"""
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_ROOT = os.path.join(REPO_ROOT, "chainlit_mcp_client")
+
+
+def use_app(**env):
+    """Make chainlit_mcp_client/app.py importable, configured like run-sse.sh plus env overrides"""
+    os.environ.setdefault("CHAINLIT_APP_ROOT", APP_ROOT)
+    os.environ.update({key: str(value) for key, value in env.items()})
+    if APP_ROOT not in sys.path:
+        sys.path.insert(0, APP_ROOT)
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.05)
+    raise RuntimeError(f"Stub server did not start on port {port}")
+
+
+def start_server(target, port, **options):
+    """Run a stub server in a child process so it does not share the measured event loop"""
+    process = multiprocessing.Process(target=target, args=(port,), kwargs=options, daemon=True)
+    process.start()
+    wait_for_port(port)
+    return process
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def rss_bytes():
+    """Resident set size of this process (Linux)"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
@@ -0,0 +1,202 @@
+"""Load test: N simulated users chatting through on_message, call_llm and call_tool.
+
+Starts the stub OpenRouter server (bench/stub_openrouter.py) and the stub MCP
+server (bench/stub_mcp.py) in child processes, then runs every simulated user
+in this process against the real app handlers with a no-op websocket emitter:
+
+    python bench/load_test.py --users 50 --turns 5 --tool-calls 2 --tool-latency-ms 50 \\
+        --output bench/results/$(date +%Y%m%d-%H%M%S).json
+
+Reports throughput, p50/p99 turn latency, event-loop lag and RSS per session,
+and writes them with the run configuration as JSON so runs can be compared.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import time
+import uuid
+from contextlib import AsyncExitStack
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import stub_mcp
+import stub_openrouter
+from common import percentile, rss_bytes, start_server, use_app
+
+
+async def monitor_loop_lag(samples, interval=0.01):
+    """Record how late the event loop wakes a sleeper, a proxy for blocking work on the loop"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+def milliseconds(value):
+    return round(value * 1000, 2) if value is not None else None
+
+
+async def noop_emit(event, data):
+    pass
+
+
+async def noop_emit_call(method, data, timeout=None):
+    return None
+
+
+async def simulated_user(index, args, mcp_url, ready, start, turn_latencies, errors):
+    import chainlit as cl
+    from chainlit.context import init_ws_context
+    from chainlit.session import WebsocketSession
+    from mcp import ClientSession
+    from mcp.client.sse import sse_client
+
+    import app
+
+    session = WebsocketSession(
+        id=str(uuid.uuid4()),
+        socket_id=str(uuid.uuid4()),
+        emit=noop_emit,
+        emit_call=noop_emit_call,
+        user_env={"OPENROUTER_API_KEY": f"sk-bench-{index}"},
+        client_type="webapp",
+        thread_id=str(uuid.uuid4()),
+    )
+    init_ws_context(session)
+    async with AsyncExitStack() as exit_stack:
+        try:
+            await app.start_chat()
+            read, write = await exit_stack.enter_async_context(sse_client(mcp_url))
+            mcp_session = await exit_stack.enter_async_context(ClientSession(read, write))
+            await mcp_session.initialize()
+            session.mcp_sessions["bench"] = (mcp_session, exit_stack)
+            connection = SimpleNamespace(name="bench", url=mcp_url, clientType="sse", headers={})
+            await app.on_mcp(connection, mcp_session)
+        finally:
+            ready.release()
+        await start.wait()
+
+        for turn in range(args.turns):
+            started = time.perf_counter()
+            try:
+                await app.on_message(cl.Message(content=f"Please look up item {turn} for user {index}"))
+                turn_latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+            if args.think_ms:
+                await asyncio.sleep(args.think_ms / 1000)
+        session.mcp_sessions.pop("bench", None)
+    # As Chainlit does when a session times out; removes files attached to its steps
+    await session.delete()
+
+
+async def run(args, mcp_url):
+    lag_samples = []
+    monitor = asyncio.create_task(monitor_loop_lag(lag_samples))
+    turn_latencies = []
+    errors = []
+    ready = asyncio.Semaphore(0)
+    start = asyncio.Event()
+
+    rss_before = rss_bytes()
+    users = [
+        asyncio.create_task(simulated_user(i, args, mcp_url, ready, start, turn_latencies, errors))
+        for i in range(args.users)
+    ]
+    for _ in users:
+        await ready.acquire()
+    rss_connected = rss_bytes()
+
+    lag_samples.clear()
+    started = time.perf_counter()
+    start.set()
+    results = await asyncio.gather(*users, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    rss_after = rss_bytes()
+    monitor.cancel()
+
+    errors.extend(f"{type(r).__name__}: {r}" for r in results if isinstance(r, BaseException))
+    return {
+        "turns": len(turn_latencies),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "elapsed_seconds": round(elapsed, 3),
+        "turns_per_second": round(len(turn_latencies) / elapsed, 2) if elapsed else None,
+        "turn_latency_ms": {
+            "mean": milliseconds(statistics.mean(turn_latencies)) if turn_latencies else None,
+            "p50": milliseconds(percentile(turn_latencies, 0.5)),
+            "p99": milliseconds(percentile(turn_latencies, 0.99)),
+            "max": milliseconds(max(turn_latencies, default=None)),
+        },
+        "event_loop_lag_ms": {
+            "p50": milliseconds(percentile(lag_samples, 0.5)),
+            "p99": milliseconds(percentile(lag_samples, 0.99)),
+            "max": milliseconds(max(lag_samples, default=None)),
+        },
+        "rss_mb": {
+            "baseline": round(rss_before / 2**20, 1),
+            "connected": round(rss_connected / 2**20, 1),
+            "after_run": round(rss_after / 2**20, 1),
+        },
+        "rss_per_session_kb": {
+            "connected": round((rss_connected - rss_before) / args.users / 1024, 1),
+            "after_run": round((rss_after - rss_before) / args.users / 1024, 1),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test with fake OpenRouter and MCP servers")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=5, help="Messages sent by each user")
+    parser.add_argument("--think-ms", type=float, default=0, help="Pause between a user's messages")
+    parser.add_argument("--tokens", type=int, default=50, help="Tokens per streamed text response")
+    parser.add_argument("--token-delay-ms", type=float, default=2.0)
+    parser.add_argument("--tool-calls", type=int, default=2, help="Tool calls the model makes per message")
+    parser.add_argument("--tool-latency-ms", type=float, default=50.0)
+    parser.add_argument("--tool-result-chars", type=int, default=500)
+    parser.add_argument("--llm-port", type=int, default=8901)
+    parser.add_argument("--mcp-port", type=int, default=8902)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    # No background catalog refresh or sweeper, and no per-user rate limit throttling the driver
+    use_app(
+        OPENROUTER_BASE_URL=f"http://127.0.0.1:{args.llm_port}",
+        MODEL_CATALOG_REFRESH_SECONDS=0,
+        SESSION_SWEEP_INTERVAL_SECONDS=0,
+        LLM_RATE_PER_MINUTE=os.environ.get("LLM_RATE_PER_MINUTE", 0),
+    )
+    servers = [
+        start_server(stub_openrouter.serve, args.llm_port, tokens=args.tokens,
+                     token_delay_ms=args.token_delay_ms, tool_calls=args.tool_calls),
+        start_server(stub_mcp.serve, args.mcp_port, latency_ms=args.tool_latency_ms,
+                     result_chars=args.tool_result_chars),
+    ]
+    try:
+        import app
+        for name in (app.__name__, "httpx", "mcp"):
+            logging.getLogger(name).setLevel(logging.WARNING)
+        results = asyncio.run(run(args, f"http://127.0.0.1:{args.mcp_port}/sse"))
+    finally:
+        for server in servers:
+            server.terminate()
+
+    report = {
+        "benchmark": "load_test",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": vars(args),
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
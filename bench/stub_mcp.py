@@ -0,0 +1,33 @@
+"""Local MCP server for benchmarks, served over SSE.
+
+Exposes one read-only tool, lookup(query), that waits --latency-ms before
+answering with --result-chars characters of text.
+
+    python bench/stub_mcp.py --port 8902 --latency-ms 50
+"""
+import argparse
+import asyncio
+
+
+def serve(port, latency_ms=50.0, result_chars=500):
+    from mcp.server.fastmcp import FastMCP
+    from mcp.types import ToolAnnotations
+
+    server = FastMCP("bench", host="127.0.0.1", port=port, log_level="WARNING")
+
+    @server.tool(annotations=ToolAnnotations(readOnlyHint=True))
+    async def lookup(query: str) -> str:
+        """Look up an item by name and return its description"""
+        await asyncio.sleep(latency_ms / 1000)
+        return (f"{query}: " + "x" * result_chars)[:result_chars]
+
+    server.run(transport="sse")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8902)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--result-chars", type=int, default=500)
+    args = parser.parse_args()
+    serve(args.port, latency_ms=args.latency_ms, result_chars=args.result_chars)
@@ -0,0 +1,107 @@
+"""Local OpenAI-compatible streaming server for benchmarks.
+
+Serves /chat/completions (streamed) and /models with a configurable number of
+tokens per response and delay per token, so latency measured against it is the
+client's own overhead plus a known server cost. With --tool-calls N, a request
+whose last message is from the user is answered with N calls of --tool-name
+instead of text; the follow-up request carrying the tool results gets text.
+Tests can also make chosen models fail with an HTTP status or hold back their first
+chunk, to exercise model fallback.
+
+    python bench/stub_openrouter.py --port 8901 --tokens 50 --token-delay-ms 2 --tool-calls 2
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+def chunk(model, delta, finish_reason=None, usage=None):
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [] if usage else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        "usage": usage,
+    }
+
+
+def tool_call_deltas(tool_calls, tool_name):
+    """Stream each call's name first and its arguments in two fragments, as providers do"""
+    for i in range(tool_calls):
+        arguments = json.dumps({"query": f"item {i}"})
+        middle = len(arguments) // 2
+        yield {"tool_calls": [{"index": i, "id": f"call_{uuid.uuid4().hex[:24]}", "type": "function",
+                               "function": {"name": tool_name, "arguments": ""}}]}
+        yield {"tool_calls": [{"index": i, "function": {"arguments": arguments[:middle]}}]}
+        yield {"tool_calls": [{"index": i, "function": {"arguments": arguments[middle:]}}]}
+
+
+def create_app(tokens=50, token_delay_ms=2.0, tool_calls=0, tool_name="lookup",
+               models=("stub/model",), model_status=None, first_chunk_delay_ms=None):
+    """model_status maps a model to the HTTP error it answers with, first_chunk_delay_ms
+    to how long it waits before its first chunk"""
+    model_status = model_status or {}
+    first_chunk_delay_ms = first_chunk_delay_ms or {}
+
+    async def completions(request):
+        body = await request.json()
+        model = body.get("model") or "stub/model"
+        if model in model_status:
+            error = {"message": f"stub error for {model}", "code": model_status[model]}
+            return JSONResponse({"error": error}, status_code=model_status[model])
+        messages = body.get("messages") or []
+        call_tools = tool_calls > 0 and body.get("tools") and messages and messages[-1].get("role") == "user"
+
+        async def events():
+            if model in first_chunk_delay_ms:
+                await asyncio.sleep(first_chunk_delay_ms[model] / 1000)
+            yield f"data: {json.dumps(chunk(model, {'role': 'assistant', 'content': ''}))}\n\n"
+            if call_tools:
+                for delta in tool_call_deltas(tool_calls, tool_name):
+                    if token_delay_ms:
+                        await asyncio.sleep(token_delay_ms / 1000)
+                    yield f"data: {json.dumps(chunk(model, delta))}\n\n"
+                yield f"data: {json.dumps(chunk(model, {}, finish_reason='tool_calls'))}\n\n"
+            else:
+                for i in range(tokens):
+                    if token_delay_ms:
+                        await asyncio.sleep(token_delay_ms / 1000)
+                    yield f"data: {json.dumps(chunk(model, {'content': f'tok{i} '}))}\n\n"
+                yield f"data: {json.dumps(chunk(model, {}, finish_reason='stop'))}\n\n"
+            usage = {"prompt_tokens": 10, "completion_tokens": tokens, "total_tokens": 10 + tokens}
+            yield f"data: {json.dumps(chunk(model, {}, usage=usage))}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    async def list_models(request):
+        return JSONResponse({"data": [{"id": model, "name": f"stub-{uuid.uuid4().hex[:6]}"} for model in models]})
+
+    return Starlette(routes=[
+        Route("/chat/completions", completions, methods=["POST"]),
+        Route("/models", list_models, methods=["GET"]),
+    ])
+
+
+def serve(port, **options):
+    import uvicorn
+    uvicorn.run(create_app(**options), host="127.0.0.1", port=port, log_level="warning")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--token-delay-ms", type=float, default=2.0)
+    parser.add_argument("--tool-calls", type=int, default=0)
+    parser.add_argument("--tool-name", default="lookup")
+    args = parser.parse_args()
+    serve(args.port, tokens=args.tokens, token_delay_ms=args.token_delay_ms,
+          tool_calls=args.tool_calls, tool_name=args.tool_name)
@@ -3,14 +3,44 @@ import asyncio
 import os
 import logging
 import hashlib
+import hmac
+import math
+import re
+import sqlite3
+import sys
+import time
+import uuid
+import contextlib
+import contextvars
+import functools
+import importlib
+from collections import OrderedDict, deque
+from types import SimpleNamespace
 from datetime import datetime
-
-from mcp import ClientSession
-import openai
+from typing import TYPE_CHECKING
 
 import chainlit as cl
 from chainlit.input_widget import Select, TextInput, Slider, Switch
+from chainlit.server import app as chainlit_server
+from chainlit.user_session import user_sessions
 from dotenv import load_dotenv
+from starlette.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Route
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# openai is imported on first use to keep it off the startup path; mcp is not,
+# chainlit imports it already, so it is only named here for type hints
+if TYPE_CHECKING:
+    from mcp import ClientSession
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -63,12 +93,197 @@ OPENROUTER_MODELS = [
     "deepseek/deepseek-chat:free"
 ]
 
+# Models offered in the settings dropdown: OPENROUTER_MODELS filtered by the cached
+# OpenRouter catalog once it is loaded, plus model -> position in the dropdown
+AVAILABLE_MODELS = list(OPENROUTER_MODELS)
+OPENROUTER_MODEL_INDEX = {model: index for index, model in enumerate(AVAILABLE_MODELS)}
+
+# OpenRouter model metadata, cached on disk and refreshed in the background
+MODEL_CATALOG_PATH = os.getenv("MODEL_CATALOG_PATH", "model_catalog.json")
+MODEL_CATALOG_REFRESH_SECONDS = float(os.getenv("MODEL_CATALOG_REFRESH_SECONDS", "21600"))
+model_catalog = {}
+_model_catalog_task = None
+
+# Model routing: "selected" always starts with the chosen model, "fastest" starts with the
+# healthy candidate that has the lowest rolling time to first token. MODEL_FALLBACK is tried
+# when the first choice times out or returns 429/5xx
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "selected")
+MODEL_ROUTING_CANDIDATES = [m.strip() for m in os.getenv("MODEL_ROUTING_CANDIDATES", "").split(",") if m.strip()]
+MODEL_FALLBACK = os.getenv("MODEL_FALLBACK", "")
+MODEL_MAX_ERROR_RATE = float(os.getenv("MODEL_MAX_ERROR_RATE", "0.5"))
+MODEL_HEALTH_ALPHA = 0.2
+# Model names come from user settings, so only this many models are tracked
+MODEL_HEALTH_MAX_MODELS = 256
+# A model's error rate halves every MODEL_ERROR_HALF_LIFE_SECONDS without new samples, so
+# a model skipped as unhealthy is tried again once its errors are old enough
+MODEL_ERROR_HALF_LIFE_SECONDS = float(os.getenv("MODEL_ERROR_HALF_LIFE_SECONDS", "120"))
+LLM_FIRST_CHUNK_TIMEOUT_SECONDS = float(os.getenv("LLM_FIRST_CHUNK_TIMEOUT_SECONDS", "30"))
+
+# model -> rolling time to first token (seconds), error rate, sample count and time of the
+# last sample, from our own traffic
+model_health = {}
+
 # Default model selection
 DEFAULT_MODEL = "google/gemini-2.5-flash"
 DEFAULT_TEMPERATURE = 0
 
-# User settings persistence
+# User settings persistence ("json" keeps one file per user, "sqlite" a single database file)
+USER_SETTINGS_BACKEND = os.getenv("USER_SETTINGS_BACKEND", "json")
 USER_SETTINGS_DIR = "user_settings"
+USER_SETTINGS_DB = os.getenv("USER_SETTINGS_DB", "user_settings.db")
+USER_SETTINGS_WRITE_DELAY_SECONDS = float(os.getenv("USER_SETTINGS_WRITE_DELAY_SECONDS", "1.0"))
+# Settings read from the backend are cached for USER_SETTINGS_CACHE_TTL_SECONDS; the Redis
+# backend is shared with other replicas, so its default is short enough to see their writes
+USER_SETTINGS_CACHE_SIZE = int(os.getenv("USER_SETTINGS_CACHE_SIZE", "1024"))
+USER_SETTINGS_CACHE_TTL_SECONDS = float(
+    os.getenv("USER_SETTINGS_CACHE_TTL_SECONDS", "5" if USER_SETTINGS_BACKEND == "redis" else "300")
+)
+
+# Shared conversation state for multi-replica deployments: "" keeps state in the chat
+# session only, "memory" uses an in-process store and "redis" any Redis-protocol server
+STATE_STORE = os.getenv("STATE_STORE", "")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+STATE_TTL_SECONDS = int(os.getenv("STATE_TTL_SECONDS", str(7 * 24 * 3600)))
+# Format of newly written state; every stored value starts with a format byte, so replicas
+# read either one. Keep "json" until msgpack is installed on every replica
+STATE_SERIALIZATION = os.getenv("STATE_SERIALIZATION", "msgpack" if msgpack is not None else "json")
+
+# OpenRouter client pooling (one client per API key, shared across turns and sessions)
+# OPENROUTER_BASE_URL can point at a local OpenAI-compatible stub for load testing
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+OPENAI_CLIENT_POOL_SIZE = int(os.getenv("OPENAI_CLIENT_POOL_SIZE", "64"))
+OPENAI_CLIENT_IDLE_SECONDS = float(os.getenv("OPENAI_CLIENT_IDLE_SECONDS", "600"))
+
+# user_id -> [client, last_used, streams in use, evicted]; ordered from least to most recently used
+_openai_clients = OrderedDict()
+openai_client_stats = {"hits": 0, "misses": 0, "evictions": 0}
+# Background import of the OpenAI SDK, started on the first chat start
+_openai_import = None
+
+# Process-wide MCP tool schema cache, shared by every chat session connected to the same server
+MCP_SCHEMA_CACHE_SIZE = int(os.getenv("MCP_SCHEMA_CACHE_SIZE", "128"))
+MCP_SCHEMA_CACHE_TTL_SECONDS = float(os.getenv("MCP_SCHEMA_CACHE_TTL_SECONDS", "300"))
+
+# server identity -> cache entry; ordered from least to most recently used
+_mcp_schema_cache = OrderedDict()
+mcp_schema_cache_stats = {"hits": 0, "misses": 0, "refreshes": 0, "evictions": 0, "bytes": 0}
+
+# Stateless MCP servers provided by the deployment and shared by every chat session.
+# MCP_SHARED_SERVERS is a JSON object of name -> {"url", "transport", "headers"}. Each one
+# gets a process-wide pool of MCP_POOL_SIZE connections instead of a connection per chat
+# session; servers users connect themselves keep their per-session connection
+MCP_SHARED_SERVERS = json.loads(os.getenv("MCP_SHARED_SERVERS", "{}"))
+MCP_POOL_SIZE = int(os.getenv("MCP_POOL_SIZE", "2"))
+MCP_POOL_CONCURRENCY_PER_CONNECTION = int(os.getenv("MCP_POOL_CONCURRENCY_PER_CONNECTION", "8"))
+MCP_POOL_HEALTH_INTERVAL_SECONDS = float(os.getenv("MCP_POOL_HEALTH_INTERVAL_SECONDS", "30"))
+MCP_POOL_MAX_BACKOFF_SECONDS = float(os.getenv("MCP_POOL_MAX_BACKOFF_SECONDS", "30"))
+MCP_POOL_CONNECT_TIMEOUT_SECONDS = float(os.getenv("MCP_POOL_CONNECT_TIMEOUT_SECONDS", "10"))
+
+# shared server name -> McpSessionPool
+_mcp_pools = {}
+mcp_pool_stats = {"pools": 0, "connects": 0, "reconnects": 0, "calls": 0}
+
+# Tool execution scheduling: concurrent calls per MCP connection and per-call deadlines.
+# TOOL_CALL_TIMEOUTS is a JSON object of per-tool overrides, e.g. {"query_sql": 120}
+MAX_CONCURRENT_TOOL_CALLS_PER_CONNECTION = int(os.getenv("MAX_CONCURRENT_TOOL_CALLS_PER_CONNECTION", "4"))
+TOOL_CALL_TIMEOUT_SECONDS = float(os.getenv("TOOL_CALL_TIMEOUT_SECONDS", "60"))
+TOOL_CALL_TIMEOUTS = json.loads(os.getenv("TOOL_CALL_TIMEOUTS", "{}"))
+
+# Tools that are safe to deduplicate or cache, in addition to those whose MCP
+# annotations set readOnlyHint
+READ_ONLY_TOOLS = {name.strip() for name in os.getenv("READ_ONLY_TOOLS", "").split(",") if name.strip()}
+
+# Identical concurrent calls of read-only tools on the same server share one MCP request
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+# (server, tool, arguments) -> future resolving to (result text, status)
+_in_flight_tool_calls = {}
+single_flight_stats = {"leaders": 0, "coalesced": 0}
+
+# Opt-in cache for results of read-only tools. A tool is eligible if it is read-only
+# or listed in TOOL_RESULT_CACHE_TOOLS.
+# TOOL_RESULT_CACHE_TTLS is a JSON object of per-tool TTL overrides in seconds
+TOOL_RESULT_CACHE_ENABLED = os.getenv("TOOL_RESULT_CACHE_ENABLED", "false").lower() == "true"
+TOOL_RESULT_CACHE_TOOLS = {name.strip() for name in os.getenv("TOOL_RESULT_CACHE_TOOLS", "").split(",") if name.strip()}
+TOOL_RESULT_CACHE_TTL_SECONDS = float(os.getenv("TOOL_RESULT_CACHE_TTL_SECONDS", "300"))
+TOOL_RESULT_CACHE_TTLS = json.loads(os.getenv("TOOL_RESULT_CACHE_TTLS", "{}"))
+TOOL_RESULT_CACHE_SIZE = int(os.getenv("TOOL_RESULT_CACHE_SIZE", "256"))
+tool_result_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+# Relevance-filtered tool subset: once more than TOOL_SELECTION_MIN_TOOLS tools are connected,
+# only the TOOL_SELECTION_TOP_K best BM25 matches for the recent conversation (plus recently
+# used tools) are sent to the model. The subset is chosen once per user message so the tool
+# loop keeps a stable prompt prefix. Set TOOL_SELECTION_TOP_K=0 to always send every tool
+TOOL_SELECTION_TOP_K = int(os.getenv("TOOL_SELECTION_TOP_K", "20"))
+TOOL_SELECTION_MIN_TOOLS = int(os.getenv("TOOL_SELECTION_MIN_TOOLS", "40"))
+TOOL_SELECTION_RECENT_TOOLS = 10
+TOOL_SELECTION_CONTEXT_MESSAGES = 4
+
+# Tool outputs above TOOL_OUTPUT_MAX_CHARS are cut to their head and tail for the model; the
+# full text is attached to the tool step as a file, which Chainlit deletes with the session
+TOOL_OUTPUT_MAX_CHARS = int(os.getenv("TOOL_OUTPUT_MAX_CHARS", "20000"))
+
+# Conversation history budget; old tool results are truncated once the estimate exceeds it
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "60000"))
+HISTORY_TRUNCATED_TOOL_CHARS = int(os.getenv("HISTORY_TRUNCATED_TOOL_CHARS", "500"))
+
+# Streaming: tokens are coalesced and sent to the UI every STREAM_FLUSH_MS (user setting)
+# or as soon as STREAM_FLUSH_CHARS characters are buffered
+DEFAULT_STREAM_FLUSH_MS = int(os.getenv("STREAM_FLUSH_MS", "50"))
+STREAM_FLUSH_CHARS = int(os.getenv("STREAM_FLUSH_CHARS", "256"))
+
+# Prometheus-style metrics endpoint mounted on the Chainlit server. Off by default; with
+# METRICS_TOKEN set, scrapes must send it as a bearer token. Label values come from user
+# data (MCP connection, tool and model names), so each label keeps at most
+# METRICS_MAX_LABEL_VALUES distinct values and any further ones are counted as "other"
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_MAX_LABEL_VALUES = int(os.getenv("METRICS_MAX_LABEL_VALUES", "100"))
+
+# Every default tool button shares this action name; the tool to call is in its payload
+TOOL_ACTION_NAME = "tool_action"
+
+# Admission control for LLM turns: a token bucket per API-key hash (LLM_RATE_PER_MINUTE
+# calls, bursts of LLM_RATE_BURST), a global cap on concurrent streams shared round-robin
+# between users, and a cap on LLM calls per user message
+LLM_RATE_PER_MINUTE = float(os.getenv("LLM_RATE_PER_MINUTE", "30"))
+LLM_RATE_BURST = float(os.getenv("LLM_RATE_BURST", "10"))
+LLM_RATE_MAX_WAIT_SECONDS = float(os.getenv("LLM_RATE_MAX_WAIT_SECONDS", "10"))
+MAX_CONCURRENT_LLM_STREAMS = int(os.getenv("MAX_CONCURRENT_LLM_STREAMS", "64"))
+MAX_TOOL_LOOP_ITERATIONS = int(os.getenv("MAX_TOOL_LOOP_ITERATIONS", "25"))
+
+# user_id -> [tokens, last refill time]
+_llm_rate_buckets = {}
+
+# Models whose providers take explicit prompt-cache breakpoints through OpenRouter
+PROMPT_CACHE_MODEL_PREFIXES = tuple(
+    p.strip() for p in os.getenv("PROMPT_CACHE_MODEL_PREFIXES", "anthropic/,google/gemini").split(",") if p.strip()
+)
+
+# Session lifecycle: state of sessions idle for SESSION_IDLE_SECONDS is released (0 disables),
+# sessions Chainlit has cleared are forgotten on the next sweep, history is capped at
+# MAX_HISTORY_MESSAGES messages (0 disables), and ADMIN_TOKEN enables the admin endpoint
+# listing the largest sessions
+SESSION_IDLE_SECONDS = float(os.getenv("SESSION_IDLE_SECONDS", "0"))
+SESSION_SWEEP_INTERVAL_SECONDS = float(os.getenv("SESSION_SWEEP_INTERVAL_SECONDS", "300"))
+MAX_HISTORY_MESSAGES = int(os.getenv("MAX_HISTORY_MESSAGES", "500"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+ADMIN_SESSIONS_PATH = os.getenv("ADMIN_SESSIONS_PATH", "/admin/sessions")
+
+# Session state released on idle eviction; chat_messages can be restored from the
+# state store when one is configured
+EVICTABLE_SESSION_KEYS = (
+    "chat_messages", "persisted_messages", "history_state", "tool_result_cache",
+    "mcp_tools_payload", "recent_tools", "tool_selection",
+)
+
+# session id -> last activity time
+_session_activity = {}
+_session_sweeper_task = None
+session_lifecycle_stats = {"evicted": 0, "ended": 0, "trimmed_messages": 0}
+
+# Bytes of tool schema sent to the model, summed over all requests
+tool_schema_stats = {"requests": 0, "bytes_sent": 0}
 
 def get_user_id_from_api_key(api_key):
     """Create a consistent user ID from API key"""
@@ -76,38 +291,546 @@ def get_user_id_from_api_key(api_key):
         return None
     return hashlib.sha256(api_key.encode()).hexdigest()[:16]
 
-def get_user_settings_path(user_id):
-    """Get the file path for user settings"""
-    os.makedirs(USER_SETTINGS_DIR, exist_ok=True)
-    return os.path.join(USER_SETTINGS_DIR, f"{user_id}.json")
+class JsonSettingsBackend:
+    """Store each user's settings in its own JSON file"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, user_id):
+        return os.path.join(self.directory, f"{user_id}.json")
+
+    def load(self, user_id):
+        path = self.path(user_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def save_many(self, settings_by_user):
+        # Created with the first save, so reading alone leaves no directory behind
+        os.makedirs(self.directory, exist_ok=True)
+        for user_id, settings in settings_by_user.items():
+            with open(self.path(user_id), 'w') as f:
+                json.dump(settings, f, indent=2)
+
+class SqliteSettingsBackend:
+    """Store all users' settings in a single SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        with sqlite3.connect(self.path) as db:
+            db.execute("CREATE TABLE IF NOT EXISTS user_settings (user_id TEXT PRIMARY KEY, settings TEXT NOT NULL)")
+
+    def load(self, user_id):
+        with sqlite3.connect(self.path) as db:
+            row = db.execute("SELECT settings FROM user_settings WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_many(self, settings_by_user):
+        with sqlite3.connect(self.path) as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO user_settings (user_id, settings) VALUES (?, ?)",
+                [(user_id, json.dumps(settings)) for user_id, settings in settings_by_user.items()],
+            )
+
+class RedisSettingsBackend:
+    """Store users' settings in a Redis hash so every replica sees them"""
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+
+    def load(self, user_id):
+        data = self.client.hget("user_settings", user_id)
+        return unpack_state(data) if data else None
+
+    def save_many(self, settings_by_user):
+        self.client.hset("user_settings", mapping={
+            user_id: pack_state(settings) for user_id, settings in settings_by_user.items()
+        })
+
+def create_settings_backend():
+    """Create the settings backend selected by USER_SETTINGS_BACKEND"""
+    if USER_SETTINGS_BACKEND == "sqlite":
+        return SqliteSettingsBackend(USER_SETTINGS_DB)
+    if USER_SETTINGS_BACKEND == "redis":
+        return RedisSettingsBackend(REDIS_URL)
+    return JsonSettingsBackend(USER_SETTINGS_DIR)
+
+STATE_FORMAT_JSON = b"\x00"
+STATE_FORMAT_MSGPACK = b"\x01"
+
+# Bad stored data and unreachable servers, as raised by every settings backend and state store
+BACKEND_ERRORS = (ValueError, OSError, sqlite3.Error)
+
+def backend_errors():
+    """BACKEND_ERRORS plus Redis errors once the Redis client is in use"""
+    redis = sys.modules.get("redis")
+    return BACKEND_ERRORS + (redis.RedisError,) if redis is not None else BACKEND_ERRORS
+
+def pack_state(value):
+    """Serialize state in the STATE_SERIALIZATION format, behind a byte naming the format"""
+    if STATE_SERIALIZATION == "msgpack" and msgpack is not None:
+        return STATE_FORMAT_MSGPACK + msgpack.packb(value, use_bin_type=True)
+    return STATE_FORMAT_JSON + json.dumps(value, separators=(",", ":")).encode()
+
+def unpack_state(data):
+    """Deserialize state written by pack_state; raises ValueError for data it cannot read"""
+    marker = data[:1]
+    if marker == STATE_FORMAT_JSON:
+        return json.loads(data[1:])
+    if marker == STATE_FORMAT_MSGPACK:
+        if msgpack is None:
+            raise ValueError("State was written with msgpack, which is not installed")
+        return msgpack.unpackb(data[1:], raw=False)
+    # Written before the format byte: JSON text, or a msgpack map or array
+    if marker >= b"\x80":
+        if msgpack is None:
+            raise ValueError("State was written with msgpack, which is not installed")
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data)
+
+class MemoryStateStore:
+    """In-process state store; the reference implementation of the store interface.
+
+    As in the Redis store, a key expires STATE_TTL_SECONDS after its last write.
+    Expired keys are dropped when read and by a sweep on writes at most once a minute.
+    """
+
+    def __init__(self, ttl=STATE_TTL_SECONDS):
+        self.ttl = ttl
+        self.lists = {}
+        self.values = {}
+        self.expires = {}
+        self.last_sweep = time.monotonic()
+
+    def _written(self, key):
+        now = time.monotonic()
+        self.expires[key] = now + self.ttl
+        if now - self.last_sweep >= 60:
+            self.last_sweep = now
+            for expired in [k for k, expires_at in self.expires.items() if expires_at <= now]:
+                self._drop(expired)
+
+    def _expire(self, key):
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._drop(key)
+
+    def _drop(self, key):
+        self.lists.pop(key, None)
+        self.values.pop(key, None)
+        self.expires.pop(key, None)
+
+    async def append(self, key, items):
+        self._expire(key)
+        self.lists.setdefault(key, []).extend(pack_state(item) for item in items)
+        self._written(key)
+
+    async def load_list(self, key):
+        self._expire(key)
+        return [unpack_state(item) for item in self.lists.get(key, [])]
+
+    async def set(self, key, value):
+        self.values[key] = pack_state(value)
+        self._written(key)
+
+    async def get(self, key):
+        self._expire(key)
+        data = self.values.get(key)
+        return unpack_state(data) if data is not None else None
+
+    async def delete(self, key):
+        self._drop(key)
+
+class RedisStateStore:
+    """State store on any Redis-protocol server; lists are appended with RPUSH, never rewritten"""
+
+    def __init__(self, url):
+        import redis.asyncio
+        self.client = redis.asyncio.Redis.from_url(url)
+
+    async def append(self, key, items):
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.rpush(key, *[pack_state(item) for item in items])
+            pipe.expire(key, STATE_TTL_SECONDS)
+            await pipe.execute()
+
+    async def load_list(self, key):
+        return [unpack_state(item) for item in await self.client.lrange(key, 0, -1)]
+
+    async def set(self, key, value):
+        await self.client.set(key, pack_state(value), ex=STATE_TTL_SECONDS)
+
+    async def get(self, key):
+        data = await self.client.get(key)
+        return unpack_state(data) if data is not None else None
+
+    async def delete(self, key):
+        await self.client.delete(key)
+
+def create_state_store():
+    """Create the conversation state store selected by STATE_STORE, or None"""
+    if STATE_STORE == "redis":
+        return RedisStateStore(REDIS_URL)
+    if STATE_STORE == "memory":
+        return MemoryStateStore()
+    return None
+
+state_store = create_state_store()
+
+def state_key(name):
+    return f"chat:{cl.context.session.thread_id}:{name}"
+
+async def persist_chat_messages(chat_messages):
+    """Append the messages added since the last save to the state store"""
+    if state_store is None:
+        return
+    persisted = cl.user_session.get("persisted_messages", 0)
+    if len(chat_messages) > persisted:
+        try:
+            await state_store.append(state_key("messages"), chat_messages[persisted:])
+        except backend_errors() as e:
+            # The unsaved messages are appended with the next turn's
+            logger.error(f"Error saving chat messages: {e}")
+            return
+        cl.user_session.set("persisted_messages", len(chat_messages))
+
+async def restore_chat_state():
+    """Load this thread's messages and settings from the state store into the user session"""
+    if state_store is None:
+        return
+    try:
+        chat_messages = await state_store.load_list(state_key("messages"))
+        settings = await state_store.get(state_key("settings"))
+    except backend_errors() as e:
+        logger.error(f"Error restoring chat state: {e}")
+        return
+    if chat_messages:
+        cl.user_session.set("chat_messages", chat_messages)
+        cl.user_session.set("persisted_messages", len(chat_messages))
+    if settings:
+        cl.user_session.set("settings", settings)
+
+# Created on first use, off the event loop, so importing the app writes nothing to disk
+settings_backend = None
+
+def get_settings_backend():
+    global settings_backend
+    if settings_backend is None:
+        settings_backend = create_settings_backend()
+    return settings_backend
+
+# Read cache (user_id -> (expires_at, settings), least recently used first) and
+# write-behind queue in front of the backend
+_user_settings_cache = OrderedDict()
+_pending_user_settings = {}
+_settings_flush_task = None
+
+def cache_user_settings(user_id, settings):
+    _user_settings_cache[user_id] = (time.monotonic() + USER_SETTINGS_CACHE_TTL_SECONDS, settings)
+    _user_settings_cache.move_to_end(user_id)
+    while len(_user_settings_cache) > USER_SETTINGS_CACHE_SIZE:
+        _user_settings_cache.popitem(last=False)
+
+def cached_user_settings(user_id):
+    entry = _user_settings_cache.get(user_id)
+    if entry and entry[0] > time.monotonic():
+        _user_settings_cache.move_to_end(user_id)
+        return entry[1]
+    if entry:
+        del _user_settings_cache[user_id]
+    return None
+
+def save_user_settings_batch(batch):
+    get_settings_backend().save_many(batch)
+
+def load_user_settings_from_backend(user_id):
+    return get_settings_backend().load(user_id)
+
+async def flush_user_settings():
+    """Write all queued settings off the event loop"""
+    while _pending_user_settings:
+        batch = dict(_pending_user_settings)
+        _pending_user_settings.clear()
+        try:
+            await asyncio.to_thread(save_user_settings_batch, batch)
+            logger.info(f"Saved settings for {len(batch)} user(s)")
+        except Exception as e:
+            logger.error(f"Error saving settings for users {list(batch)}: {e}")
+
+async def _flush_user_settings():
+    """Write queued settings after a short delay, coalescing rapid changes per user"""
+    await asyncio.sleep(USER_SETTINGS_WRITE_DELAY_SECONDS)
+    await flush_user_settings()
+
+@cl.on_app_shutdown
+async def on_app_shutdown():
+    """Write settings still waiting in the queue before the process exits"""
+    if _settings_flush_task is not None and not _settings_flush_task.done():
+        _settings_flush_task.cancel()
+    await flush_user_settings()
 
 def save_user_settings(user_id, settings):
-    """Save user's preferred settings"""
+    """Save user's preferred settings (cached now, written to the backend shortly after)"""
+    global _settings_flush_task
     if not user_id:
         return
-    path = get_user_settings_path(user_id)
     settings_with_timestamp = {
         **settings,
         "last_updated": datetime.now().isoformat()
     }
-    with open(path, 'w') as f:
-        json.dump(settings_with_timestamp, f, indent=2)
-    logger.info(f"Saved settings for user {user_id}: {settings}")
+    cache_user_settings(user_id, settings_with_timestamp)
+    _pending_user_settings[user_id] = settings_with_timestamp
+    if _settings_flush_task is None or _settings_flush_task.done():
+        _settings_flush_task = asyncio.get_running_loop().create_task(_flush_user_settings())
+    logger.info(f"Queued settings for user {user_id}: {settings}")
 
-def load_user_settings(user_id):
+async def load_user_settings(user_id):
     """Load user's saved settings, return None if none exist"""
     if not user_id:
         return None
-    path = get_user_settings_path(user_id)
-    if os.path.exists(path):
-        try:
-            with open(path, 'r') as f:
-                settings = json.load(f)
-            logger.info(f"Loaded settings for user {user_id}: {settings}")
-            return settings
-        except (json.JSONDecodeError, FileNotFoundError) as e:
-            logger.error(f"Error loading settings for user {user_id}: {e}")
-    return None
+    # Changes not yet written win over what the backend holds
+    settings = _pending_user_settings.get(user_id) or cached_user_settings(user_id)
+    if settings is not None:
+        return settings
+    try:
+        settings = await asyncio.to_thread(load_user_settings_from_backend, user_id)
+    except backend_errors() as e:
+        logger.error(f"Error loading settings for user {user_id}: {e}")
+        return None
+    if settings is not None:
+        cache_user_settings(user_id, settings)
+        logger.info(f"Loaded settings for user {user_id}: {settings}")
+    return settings
+
+# Metrics and tracing
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Counter:
+    """Prometheus-style counter with optional labels"""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+class Histogram:
+    """Prometheus-style histogram with optional labels"""
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}  # labels -> [bucket counts, sum, count]
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        series = self.series.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (bucket_counts, total, count) in self.series.items():
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', str(bound)),))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+# label name -> values seen so far
+_metric_label_values = {}
+
+def metric_label(name, value):
+    """Clean a label value and fold it into "other" once the label has too many values"""
+    value = re.sub(r"[^A-Za-z0-9_.:/@-]", "_", str(value))[:64]
+    seen = _metric_label_values.setdefault(name, set())
+    if value not in seen:
+        if len(seen) >= METRICS_MAX_LABEL_VALUES:
+            return "other"
+        seen.add(value)
+    return value
+
+def label_key(labels):
+    return tuple(sorted((name, metric_label(name, value)) for name, value in labels.items()))
+
+def format_labels(key):
+    if not key:
+        return ""
+    escaped = ((k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in key)
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+LLM_TIME_TO_FIRST_TOKEN = Histogram("llm_time_to_first_token_seconds", "Time from request to first streamed chunk")
+LLM_STREAM_DURATION = Histogram("llm_stream_duration_seconds", "Time from request to end of stream")
+LLM_RESPONSE_CHUNKS = Counter("llm_response_chunks_total", "Streamed chunks received from the model")
+LLM_PROMPT_TOKENS = Counter("llm_prompt_tokens_total", "Prompt tokens reported by the model")
+LLM_CACHED_PROMPT_TOKENS = Counter("llm_cached_prompt_tokens_total", "Prompt tokens served from the provider's prompt cache")
+LLM_FALLBACKS = Counter("llm_fallbacks_total", "Requests moved to the next model after a timeout, 429 or 5xx")
+LLM_RESPONSE_TOKENS = Counter("llm_response_tokens_total", "Completion tokens reported by the model")
+TOOL_CALL_DURATION = Histogram("mcp_tool_call_duration_seconds", "MCP tool call latency")
+LLM_QUEUE_WAIT = Histogram("llm_queue_wait_seconds", "Time a turn waited for rate limit and stream slot")
+LLM_RATE_LIMITED = Counter("llm_rate_limited_total", "LLM calls rejected by the per-user rate limit")
+MESSAGE_LOOP_ITERATIONS = Histogram(
+    "message_loop_iterations", "LLM calls made for a single user message", buckets=(1, 2, 3, 5, 8, 13, 21)
+)
+METRICS = [
+    LLM_TIME_TO_FIRST_TOKEN,
+    LLM_STREAM_DURATION,
+    LLM_RESPONSE_CHUNKS,
+    LLM_RESPONSE_TOKENS,
+    LLM_PROMPT_TOKENS,
+    LLM_CACHED_PROMPT_TOKENS,
+    LLM_FALLBACKS,
+    TOOL_CALL_DURATION,
+    LLM_QUEUE_WAIT,
+    LLM_RATE_LIMITED,
+    MESSAGE_LOOP_ITERATIONS,
+]
+
+# Plain stats dictionaries kept by the caches and pools, exported as gauges
+STATS = {}
+
+def render_metrics():
+    """Render all metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for prefix, stats in STATS.items():
+        for key, value in stats.items():
+            if isinstance(value, (int, float)):
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {value}")
+    lines.append("# TYPE chat_sessions_tracked gauge")
+    lines.append(f"chat_sessions_tracked {len(_session_activity)}")
+    lines.append("# TYPE llm_streams_active gauge")
+    lines.append(f"llm_streams_active {llm_stream_scheduler.active}")
+    lines.append("# TYPE llm_stream_queue_depth gauge")
+    lines.append(f"llm_stream_queue_depth {llm_stream_scheduler.queue_depth()}")
+    for model, health in model_health.items():
+        label = metric_label("model", model)
+        if label == "other":
+            continue
+        labels = format_labels((("model", label),))
+        if health["ttft"] is not None:
+            lines.append(f"llm_model_ttft_rolling_seconds{labels} {health['ttft']}")
+        lines.append(f"llm_model_error_rate_rolling{labels} {model_error_rate(model)}")
+    return "\n".join(lines) + "\n"
+
+STATS["openai_client_pool"] = openai_client_stats
+STATS["mcp_schema_cache"] = mcp_schema_cache_stats
+STATS["tool_schema"] = tool_schema_stats
+STATS["tool_result_cache"] = tool_result_cache_stats
+STATS["tool_single_flight"] = single_flight_stats
+STATS["session_lifecycle"] = session_lifecycle_stats
+STATS["mcp_pool"] = mcp_pool_stats
+
+async def metrics_endpoint(request):
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return PlainTextResponse("unauthorized", status_code=401)
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+if METRICS_ENABLED:
+    # Insert ahead of Chainlit's catch-all frontend route, replacing any route left by a reload
+    chainlit_server.router.routes[:] = [
+        route for route in chainlit_server.router.routes if getattr(route, "path", None) != METRICS_PATH
+    ]
+    chainlit_server.router.routes.insert(0, Route(METRICS_PATH, metrics_endpoint, methods=["GET"]))
+
+def estimate_size(value, skip, seen):
+    """Approximate the bytes held by an object graph, not counting ids in skip or seen"""
+    total = 0
+    stack = [value]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in skip or id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+    return total
+
+def session_footprints():
+    """Estimate bytes per session and per user-session key.
+
+    Tool schemas shared through the process-wide schema cache are excluded, so
+    each session is charged only for what it holds on its own.
+    """
+    shared = set()
+    estimate_size(list(_mcp_schema_cache.values()), set(), shared)
+    footprints = []
+    now = time.monotonic()
+    for session_id, data in list(user_sessions.items()):
+        seen = set()
+        components = {key: estimate_size(value, shared, seen) for key, value in list(data.items())}
+        last_active = _session_activity.get(session_id)
+        footprints.append({
+            "session_id": session_id,
+            "bytes": sum(components.values()),
+            "idle_seconds": round(now - last_active, 1) if last_active else None,
+            "messages": len(data.get("chat_messages") or []),
+            "components": dict(sorted(components.items(), key=lambda item: item[1], reverse=True)),
+        })
+    return sorted(footprints, key=lambda footprint: footprint["bytes"], reverse=True)
+
+async def admin_sessions_endpoint(request):
+    if not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {ADMIN_TOKEN}"):
+        return JSONResponse({"error": "unauthorized"}, status_code=401)
+    try:
+        limit = max(0, int(request.query_params.get("limit", "20")))
+    except ValueError:
+        return JSONResponse({"error": "limit must be an integer"}, status_code=400)
+    footprints = session_footprints()
+    return JSONResponse({
+        "sessions": len(footprints),
+        "total_bytes": sum(footprint["bytes"] for footprint in footprints),
+        "largest": footprints[:limit],
+    })
+
+if ADMIN_TOKEN:
+    chainlit_server.router.routes[:] = [
+        route for route in chainlit_server.router.routes if getattr(route, "path", None) != ADMIN_SESSIONS_PATH
+    ]
+    chainlit_server.router.routes.insert(0, Route(ADMIN_SESSIONS_PATH, admin_sessions_endpoint, methods=["GET"]))
+
+def trace_span(name, **attributes):
+    """Start an OpenTelemetry span if opentelemetry is installed, otherwise do nothing"""
+    if otel_trace is None:
+        return contextlib.nullcontext()
+    return otel_trace.get_tracer(__name__).start_as_current_span(name, attributes=attributes)
+
+def set_span_attributes(**attributes):
+    if otel_trace is not None:
+        otel_trace.get_current_span().set_attributes(attributes)
+
+def traced(name):
+    """Run an async function inside an OpenTelemetry span"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 import chainlit as cl
 
@@ -116,29 +839,65 @@ async def action_button_callback(action):
     await handle_action(action)
 
 
+@cl.action_callback(TOOL_ACTION_NAME)
+async def tool_action_callback(action):
+    await handle_action(action)
+
+
 @cl.action_callback("list_tools")
 async def list_tools_callback(action):
-    """Send the list tools prompt to the LLM"""
-    # Create a fake message with the starter prompt
-    starter_message = "Can you list your available tools. Make sure to give the names and parameters and a description. Format it in table."
-    
-    class FakeMessage:
-        def __init__(self, content):
-            self.content = content
-    
-    fake_msg = FakeMessage(starter_message)
-    await on_message(fake_msg)
+    """Render the connected tools as a table straight from the stored tool schemas"""
+    mcp_tools_data = cl.user_session.get("mcp_tools_data") or {}
+    rows = []
+    for connection_name, tools in mcp_tools_data.items():
+        for tool in tools:
+            params = ", ".join((tool.get("input_schema") or {}).get("properties", {}))
+            description = (tool.get("description") or "").replace("|", "\\|").replace("\n", " ")
+            rows.append(f"| `{tool['name']}` | {params} | {description} | {connection_name} |")
 
-    
+    if not rows:
+        await cl.Message(content="No tools are connected.").send()
+        return
+    table = "\n".join(["| Tool | Parameters | Description | Connection |", "|---|---|---|---|"] + rows)
+    await cl.Message(content=table).send()
+
+
+async def run_tool_directly(tool_name, params, connection_name=None):
+    """Call a tool whose name and arguments are already known, without a model round trip.
+
+    The call and its result are added to chat_messages as an assistant tool call and
+    a tool message, so the model sees them on later turns. With connection_name the
+    call goes to that connection even if another one owns the tool name.
+    """
+    tool_call_dict = {
+        "id": f"call_{uuid.uuid4().hex[:24]}",
+        "type": "function",
+        "function": {"name": tool_name, "arguments": json.dumps(params or {})},
+    }
+    result = await call_tool(to_tool_call(tool_call_dict), connection_name)
+
+    chat_messages = await load_chat_messages()
+    chat_messages.append({"role": "assistant", "content": "", "tool_calls": [tool_call_dict]})
+    chat_messages.append({
+        "role": "tool",
+        "tool_call_id": result["tool_call_id"],
+        "name": result["name"],
+        "content": result["output"],
+    })
+    cl.user_session.set("chat_messages", chat_messages)
+    await persist_chat_messages(chat_messages)
+
+    await cl.Message(content=f"```\n{result['output']}\n```").send()
 
 
 async def handle_action(action):
     """Handle all action button clicks"""
+    touch_session()
     if action.name == "action_button":
         await cl.Message(content=f"Executed {action.name}").send()
         return
     
-    # Handle tool-specific action button clicks
+    # Handle tool action button clicks
     if action.name.startswith("tool_"):
         payload = action.payload
         tool_name = payload.get("tool_name")
@@ -146,31 +905,11 @@ async def handle_action(action):
         connection_name = payload.get("connection")
         
         # Format parameters as function call
-        if params:
-            # Format values properly (strings in quotes, others as-is)
-            formatted_params = []
-            for k, v in params.items():
-                if isinstance(v, str):
-                    formatted_params.append(f'"{v}"')
-                else:
-                    formatted_params.append(str(v))
-            params_str = ",".join(formatted_params)
-        else:
-            params_str = ""
-        
-        # Create a message that looks like a function call
-        message_content = f"Call {tool_name}({params_str})"
-        
-        # Show the function call and process it
-        await cl.Message(content=f"⚡ {message_content}").send()
-        
-        # Create a fake message object and trigger the message handler
-        class FakeMessage:
-            def __init__(self, content):
-                self.content = content
+        params_str = format_call_params(params)
         
-        fake_msg = FakeMessage(message_content)
-        await on_message(fake_msg)
+        # Show the function call and run it directly; the model is not needed
+        await cl.Message(content=f"⚡ Call {tool_name}({params_str})").send()
+        await run_tool_directly(tool_name, params, connection_name)
 
 @cl.on_chat_start
 async def start():
@@ -181,6 +920,24 @@ async def start():
 
     await cl.Message(content="Interact with this action button:", actions=actions).send()
 
+def format_call_params(params):
+    """Format parameter values as call arguments (strings in quotes, others as-is)"""
+    return ",".join(f'"{v}"' if isinstance(v, str) else str(v) for v in (params or {}).values())
+
+def build_tool_buttons(mcp_raw_tools):
+    """Precompute (tool name, sample params, label) for tools whose required params all have defaults"""
+    buttons = []
+    for tool in mcp_raw_tools:
+        # Generate sample parameters based on the tool's input schema
+        sample_params = generate_sample_params(tool.get("input_schema", {}), tool["name"])
+
+        # Skip this tool if it doesn't have complete defaults
+        if sample_params is None:
+            continue
+
+        buttons.append((tool["name"], sample_params, f"🛠️ {tool['name']}({format_call_params(sample_params)})"))
+    return tuple(buttons)
+
 def flatten(xss):
     return [x for xs in xss for x in xs]
 
@@ -218,82 +975,422 @@ async def set_starters():
 
 # Convert MCP tool schema to OpenAI tool schema
 def mcp_to_openai_tool(mcp_tool):
+    # Key order is normalized so the serialized schema is byte-identical every time
     return {
         "type": "function",
         "function": {
             "name": mcp_tool["name"],
             "description": mcp_tool["description"],
-            "parameters": mcp_tool["input_schema"],
+            "parameters": json.loads(json.dumps(mcp_tool["input_schema"], sort_keys=True)),
         }
     }
 
-@cl.on_mcp_connect
-async def on_mcp(connection, session: ClientSession):
+JSON_SCHEMA_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "null": type(None),
+}
+
+def compile_schema(schema):
+    """Compile a JSON schema into a function returning a list of error messages for a value.
+
+    Checks type, enum, required, properties, additionalProperties: false and items;
+    other keywords are accepted without checking. Compiling once per tool keeps
+    per-call validation to a few dict and isinstance checks.
+    """
+    if not isinstance(schema, dict):
+        return lambda value, path="$": []
+
+    checks = []
+    types = schema.get("type")
+    if types:
+        type_names = types if isinstance(types, list) else [types]
+
+        def check_type(value, path):
+            for name in type_names:
+                if isinstance(value, bool) and name in ("integer", "number"):
+                    continue
+                if name == "integer" and isinstance(value, float) and value.is_integer():
+                    return []
+                expected = JSON_SCHEMA_TYPES.get(name)
+                if expected is None or isinstance(value, expected):
+                    return []
+            return [f"{path}: expected {' or '.join(type_names)}, got {type(value).__name__}"]
+        checks.append(check_type)
+
+    if "enum" in schema:
+        allowed = schema["enum"]
+        checks.append(lambda value, path: [] if value in allowed else [f"{path}: must be one of {allowed}"])
+
+    required = schema.get("required") or []
+    if required:
+        checks.append(lambda value, path: [
+            f"{path}: missing required property '{name}'" for name in required
+            if isinstance(value, dict) and name not in value
+        ])
+
+    properties = {name: compile_schema(sub) for name, sub in (schema.get("properties") or {}).items()}
+    if properties:
+        def check_properties(value, path):
+            if not isinstance(value, dict):
+                return []
+            errors = []
+            for name, validate_property in properties.items():
+                if name in value:
+                    errors.extend(validate_property(value[name], f"{path}.{name}"))
+            return errors
+        checks.append(check_properties)
+
+    if schema.get("additionalProperties") is False:
+        known = set(properties)
+        checks.append(lambda value, path: [
+            f"{path}: unexpected property '{name}'" for name in value if name not in known
+        ] if isinstance(value, dict) else [])
+
+    if isinstance(schema.get("items"), dict):
+        validate_item = compile_schema(schema["items"])
+        checks.append(lambda value, path: [
+            error for i, item in enumerate(value) for error in validate_item(item, f"{path}[{i}]")
+        ] if isinstance(value, list) else [])
+
+    def validate(value, path="$"):
+        errors = []
+        for check in checks:
+            errors.extend(check(value, path))
+            # Later checks assume the type matched
+            if errors and check is checks[0] and types:
+                break
+        return errors
+    return validate
+
+def build_tool_index(mcp_tools_data):
+    """Map each tool name to its (connection name, raw tool) and collect name collisions.
+
+    Connections are scanned in the order they were added, so the first connection
+    to expose a tool name owns it; later duplicates are reported, not silently dropped.
+    """
+    tool_index = {}
+    collisions = {}
+    for connection_name, tools in mcp_tools_data.items():
+        for tool in tools:
+            name = tool["name"]
+            if name in tool_index:
+                owner = tool_index[name][0]
+                collisions.setdefault(name, [owner]).append(connection_name)
+                continue
+            tool_index[name] = (connection_name, tool)
+    return tool_index, collisions
+
+def refresh_tool_index(mcp_tools_data):
+    """Rebuild the tool routing table in the user session after the connection set changes"""
+    tool_index, collisions = build_tool_index(mcp_tools_data)
+    for name, connections in collisions.items():
+        logger.warning(f"Tool {name} is provided by {connections}; calls will go to {connections[0]}")
+    cl.user_session.set("mcp_tool_index", tool_index)
+    cl.user_session.set("mcp_tool_collisions", collisions)
+    return tool_index
+
+def tokenize(text):
+    return re.findall(r"[a-z0-9]+", (text or "").lower())
+
+def build_tool_search_index(tools, k1=1.5, b=0.75):
+    """Build a BM25 index over tool names and descriptions.
+
+    Returns postings of term -> [(tool position, term weight)] with the BM25 length
+    normalization and idf folded in, so a query only sums precomputed weights.
+    """
+    docs = []
+    for tool in tools:
+        function = tool["function"]
+        docs.append(tokenize(function["name"].replace("_", " ")) + tokenize(function.get("description")))
+    avg_len = sum(len(doc) for doc in docs) / len(docs) if docs else 0
+    frequencies = {}
+    for position, doc in enumerate(docs):
+        counts = {}
+        for term in doc:
+            counts[term] = counts.get(term, 0) + 1
+        for term, count in counts.items():
+            frequencies.setdefault(term, []).append((position, count, len(doc)))
+    postings = {}
+    for term, entries in frequencies.items():
+        idf = math.log(1 + (len(docs) - len(entries) + 0.5) / (len(entries) + 0.5))
+        postings[term] = [
+            (position, idf * count * (k1 + 1) / (count + k1 * (1 - b + b * doc_len / avg_len)))
+            for position, count, doc_len in entries
+        ]
+    return postings
+
+def refresh_tools_payload(mcp_openai_tools):
+    """Flatten the OpenAI-formatted tools once per change to the connection set.
+
+    call_llm reuses the cached list on every turn; the version is bumped on each
+    rebuild and the serialized size is kept for the per-request byte metric.
+    Large catalogs also get a BM25 index for select_tools.
+    """
+    previous = cl.user_session.get("mcp_tools_payload") or {}
+    # A name offered by several connections is sent once: the first connection owns it,
+    # as in build_tool_index, so the model never sees a shadowed duplicate
+    tools_by_name = {}
+    for tool in flatten(mcp_openai_tools.values()):
+        tools_by_name.setdefault(tool["function"]["name"], tool)
+    # Sorted by name so the tools prefix stays identical when connections come and go
+    # in a different order, which keeps provider prompt caches warm
+    tools = [tools_by_name[name] for name in sorted(tools_by_name)]
+    tool_sizes = [len(json.dumps(tool).encode()) for tool in tools]
+    payload = {
+        "version": previous.get("version", 0) + 1,
+        "tools": tools,
+        "tool_sizes": tool_sizes,
+        "size_bytes": sum(tool_sizes) + len(tools) + 1 if tools else 0,
+        "search_index": build_tool_search_index(tools) if len(tools) > TOOL_SELECTION_MIN_TOOLS else None,
+    }
+    cl.user_session.set("mcp_tools_payload", payload)
+    return payload
+
+def mcp_server_identity(connection):
+    """Identify an MCP server by name, transport target and a hash of its headers"""
+    headers = getattr(connection, "headers", None) or {}
+    identity = {
+        "name": connection.name,
+        "url": getattr(connection, "url", None),
+        "command": getattr(connection, "command", None),
+        "args": getattr(connection, "args", None),
+        "headers": hashlib.sha256(json.dumps(headers, sort_keys=True).encode()).hexdigest()[:16],
+    }
+    return json.dumps(identity, sort_keys=True, default=str)
+
+def mcp_schema_cache_info():
+    """Return hit rate and memory footprint of the shared MCP schema cache"""
+    lookups = mcp_schema_cache_stats["hits"] + mcp_schema_cache_stats["misses"]
+    return {
+        **mcp_schema_cache_stats,
+        "entries": len(_mcp_schema_cache),
+        "hit_rate": mcp_schema_cache_stats["hits"] / lookups if lookups else 0.0,
+    }
+
+async def get_mcp_tool_schemas(connection, session: "ClientSession"):
+    """Return the cached tool schemas for a server, listing and converting them only when needed.
+
+    Within the TTL the cached entry is reused without a list_tools round trip. After
+    it expires the tools are listed again, and if their fingerprint is unchanged the
+    existing immutable tuples are kept so every session keeps sharing one copy.
+    """
+    identity = mcp_server_identity(connection)
+    now = time.monotonic()
+    entry = _mcp_schema_cache.get(identity)
+    if entry and now - entry["fetched_at"] < MCP_SCHEMA_CACHE_TTL_SECONDS:
+        _mcp_schema_cache.move_to_end(identity)
+        mcp_schema_cache_stats["hits"] += 1
+        return entry
+
+    mcp_schema_cache_stats["misses"] += 1
     result = await session.list_tools()
     # Store raw MCP tool definitions
-    mcp_raw_tools = [{
+    mcp_raw_tools = tuple({
         "name": t.name,
         "description": t.description,
         "input_schema": t.inputSchema,
-        } for t in result.tools]
+        "read_only": bool(getattr(t.annotations, "readOnlyHint", False)),
+        } for t in result.tools)
+    serialized = json.dumps(mcp_raw_tools, sort_keys=True, default=str).encode()
+    fingerprint = hashlib.sha256(serialized).hexdigest()
+
+    if entry and entry["fingerprint"] == fingerprint:
+        mcp_schema_cache_stats["refreshes"] += 1
+        entry["fetched_at"] = now
+        _mcp_schema_cache.move_to_end(identity)
+        return entry
+
+    if entry:
+        mcp_schema_cache_stats["bytes"] -= entry["size_bytes"]
+    entry = {
+        "fingerprint": fingerprint,
+        "raw_tools": mcp_raw_tools,
+        "openai_tools": tuple(mcp_to_openai_tool(tool) for tool in mcp_raw_tools),
+        "buttons": build_tool_buttons(mcp_raw_tools),
+        "validators": {tool["name"]: compile_schema(tool["input_schema"]) for tool in mcp_raw_tools},
+        "size_bytes": len(serialized),
+        "fetched_at": now,
+    }
+    _mcp_schema_cache[identity] = entry
+    _mcp_schema_cache.move_to_end(identity)
+    mcp_schema_cache_stats["bytes"] += entry["size_bytes"]
+
+    while len(_mcp_schema_cache) > MCP_SCHEMA_CACHE_SIZE:
+        _, evicted = _mcp_schema_cache.popitem(last=False)
+        mcp_schema_cache_stats["bytes"] -= evicted["size_bytes"]
+        mcp_schema_cache_stats["evictions"] += 1
+
+    return entry
+
+class McpSessionPool:
+    """A fixed number of MCP connections to one stateless server, shared by all chat sessions.
+
+    Each connection is owned by a background task that connects, pings the server every
+    MCP_POOL_HEALTH_INTERVAL_SECONDS and reconnects with exponential backoff. Calls are
+    admitted round-robin between chat sessions and go to the least busy live connection.
+    """
+
+    def __init__(self, name, url, transport="sse", headers=None):
+        self.connection = SimpleNamespace(name=name, url=url, clientType=transport, headers=headers or {})
+        self.sessions = [None] * MCP_POOL_SIZE
+        self.in_flight = [0] * MCP_POOL_SIZE
+        self.scheduler = FairStreamScheduler(MCP_POOL_SIZE * MCP_POOL_CONCURRENCY_PER_CONNECTION)
+        self.ready = asyncio.Event()
+        # Run outside the creating chat session's context so the pool does not keep it alive
+        self.workers = [
+            asyncio.get_running_loop().create_task(self._run_connection(slot), context=contextvars.Context())
+            for slot in range(MCP_POOL_SIZE)
+        ]
+
+    @contextlib.asynccontextmanager
+    async def _open(self):
+        from mcp import ClientSession
+        url, headers = self.connection.url, self.connection.headers
+        if self.connection.clientType == "streamable-http":
+            from mcp.client.streamable_http import streamablehttp_client
+            transport = streamablehttp_client(url, headers=headers)
+        else:
+            from mcp.client.sse import sse_client
+            transport = sse_client(url, headers=headers)
+        async with transport as streams:
+            async with ClientSession(streams[0], streams[1]) as session:
+                await session.initialize()
+                yield session
+
+    async def _run_connection(self, slot):
+        backoff = 1
+        while True:
+            try:
+                async with self._open() as session:
+                    self.sessions[slot] = session
+                    self.ready.set()
+                    mcp_pool_stats["connects"] += 1
+                    backoff = 1
+                    while True:
+                        await asyncio.sleep(MCP_POOL_HEALTH_INTERVAL_SECONDS)
+                        await asyncio.wait_for(session.send_ping(), MCP_POOL_HEALTH_INTERVAL_SECONDS)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Pooled MCP connection {slot} to {self.connection.name} failed: {e}")
+                mcp_pool_stats["reconnects"] += 1
+            finally:
+                self.sessions[slot] = None
+                if not any(self.sessions):
+                    self.ready.clear()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, MCP_POOL_MAX_BACKOFF_SECONDS)
+
+    @contextlib.asynccontextmanager
+    async def _use(self, client_id):
+        """Wait for a turn and hold the least busy live connection"""
+        async with self.scheduler.slot(client_id):
+            try:
+                await asyncio.wait_for(self.ready.wait(), MCP_POOL_CONNECT_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                raise RuntimeError(f"No healthy pooled MCP connection to {self.connection.name}") from None
+            live = [slot for slot, session in enumerate(self.sessions) if session is not None]
+            slot = min(live, key=self.in_flight.__getitem__)
+            self.in_flight[slot] += 1
+            try:
+                yield self.sessions[slot]
+            finally:
+                self.in_flight[slot] -= 1
+
+    async def list_tools(self):
+        async with self._use(None) as session:
+            return await session.list_tools()
+
+    async def call_tool(self, tool_name, arguments, client_id=None):
+        mcp_pool_stats["calls"] += 1
+        async with self._use(client_id) as session:
+            return await session.call_tool(tool_name, arguments)
+
+    def session_for(self, client_id):
+        """A ClientSession stand-in whose calls queue fairly under client_id"""
+        return SimpleNamespace(call_tool=functools.partial(self.call_tool, client_id=client_id))
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+def get_shared_mcp_pools():
+    """Return the pools of MCP_SHARED_SERVERS, starting each one on first use"""
+    for name, server in MCP_SHARED_SERVERS.items():
+        if name not in _mcp_pools:
+            _mcp_pools[name] = McpSessionPool(name, server["url"], server.get("transport", "sse"), server.get("headers"))
+            mcp_pool_stats["pools"] += 1
+    return _mcp_pools
+
+async def attach_shared_mcp_server(pool):
+    """Offer a shared server's tools to this chat session; its calls go through the pool"""
+    try:
+        schemas = await get_mcp_tool_schemas(pool.connection, pool)
+    except Exception as e:
+        logger.warning(f"Shared MCP server {pool.connection.name} is unavailable: {e}")
+        return
+    register_mcp_tools(pool.connection, schemas)
+
+async def attach_shared_mcp_servers():
+    for pool in list(get_shared_mcp_pools().values()):
+        await attach_shared_mcp_server(pool)
+
+def register_mcp_tools(connection, schemas):
+    """Add a connection's tools, validators and routing entries to the user session"""
+    mcp_raw_tools = schemas["raw_tools"]
+
+    # Argument validators are compiled once per schema and shared through the schema cache
+    mcp_tool_validators = cl.user_session.get("mcp_tool_validators") or {}
+    mcp_tool_validators[connection.name] = schemas["validators"]
+    cl.user_session.set("mcp_tool_validators", mcp_tool_validators)
+
+    # Identical read-only calls are deduplicated per server, across chat sessions
+    mcp_server_keys = cl.user_session.get("mcp_server_keys") or {}
+    mcp_server_keys[connection.name] = mcp_server_identity(connection)
+    cl.user_session.set("mcp_server_keys", mcp_server_keys)
 
-    mcp_tools_data = cl.user_session.get("mcp_tools_data", {})
+    mcp_tools_data = cl.user_session.get("mcp_tools_data") or {}
     mcp_tools_data[connection.name] = mcp_raw_tools
     cl.user_session.set("mcp_tools_data", mcp_tools_data)
+    refresh_tool_index(mcp_tools_data)
 
     # Also store OpenAI formatted tools for easy access later
-    openai_tools = [mcp_to_openai_tool(tool) for tool in mcp_raw_tools]
-    mcp_openai_tools = cl.user_session.get("mcp_openai_tools", {})
+    openai_tools = schemas["openai_tools"]
+    mcp_openai_tools = cl.user_session.get("mcp_openai_tools") or {}
     mcp_openai_tools[connection.name] = openai_tools
     cl.user_session.set("mcp_openai_tools", mcp_openai_tools)
+    refresh_tools_payload(mcp_openai_tools)
+
+@cl.on_mcp_connect
+async def on_mcp(connection, session: "ClientSession"):
+    schemas = await get_mcp_tool_schemas(connection, session)
+    register_mcp_tools(connection, schemas)
 
     # Check if user wants default tool call buttons
     settings = cl.user_session.get("settings", {})
     create_tool_buttons = settings.get("CreateToolButtons", False)
     
     if create_tool_buttons:
-        # Create action buttons for each tool with sample parameters
-        actions = []
-        for tool in mcp_raw_tools:
-            # Generate sample parameters based on the tool's input schema
-            sample_params = generate_sample_params(tool.get("input_schema", {}), tool["name"])
-            
-            # Skip this tool if it doesn't have complete defaults
-            if sample_params is None:
-                continue
-            
-            action_name = f"tool_{tool['name']}"
-            
-            # Register callback for this specific tool action
-            @cl.action_callback(action_name)
-            async def tool_action_callback(action):
-                await handle_action(action)
-            
-            # Format parameters for button label
-            if sample_params:
-                # Format values properly (strings in quotes, others as-is)
-                formatted_params = []
-                for k, v in sample_params.items():
-                    if isinstance(v, str):
-                        formatted_params.append(f'"{v}"')
-                    else:
-                        formatted_params.append(str(v))
-                params_display = ",".join(formatted_params)
-                button_label = f"🛠️ {tool['name']}({params_display})"
-            else:
-                button_label = f"🛠️ {tool['name']}()"
-            
-            actions.append(
-                cl.Action(
-                    name=action_name, 
-                    payload={
-                        "tool_name": tool["name"],
-                        "params": sample_params,
-                        "connection": connection.name
-                    }, 
-                    label=button_label
-                )
+        # Create action buttons from the button metadata cached with the tool schemas;
+        # they all dispatch through the single tool action callback
+        actions = [
+            cl.Action(
+                name=TOOL_ACTION_NAME,
+                payload={
+                    "tool_name": tool_name,
+                    "params": sample_params,
+                    "connection": connection.name
+                },
+                label=button_label
             )
+            for tool_name, sample_params, button_label in schemas["buttons"]
+        ]
         
         if actions:
             # Create control buttons that go first
@@ -318,155 +1415,770 @@ async def on_mcp(connection, session: ClientSession):
                 actions=all_actions
             ).send()
 
+@cl.on_mcp_disconnect
+async def on_mcp_disconnect(name: str, session: "ClientSession"):
+    """Drop a disconnected server's tools so they are no longer offered or routed"""
+    mcp_tools_data = cl.user_session.get("mcp_tools_data") or {}
+    mcp_tools_data.pop(name, None)
+    cl.user_session.set("mcp_tools_data", mcp_tools_data)
+
+    mcp_server_keys = cl.user_session.get("mcp_server_keys") or {}
+    mcp_server_keys.pop(name, None)
+    cl.user_session.set("mcp_server_keys", mcp_server_keys)
+
+    mcp_tool_validators = cl.user_session.get("mcp_tool_validators") or {}
+    mcp_tool_validators.pop(name, None)
+    cl.user_session.set("mcp_tool_validators", mcp_tool_validators)
+
+    mcp_openai_tools = cl.user_session.get("mcp_openai_tools") or {}
+    mcp_openai_tools.pop(name, None)
+    cl.user_session.set("mcp_openai_tools", mcp_openai_tools)
+    refresh_tools_payload(mcp_openai_tools)
+
+    refresh_tool_index(mcp_tools_data)
+
+    # A user connection may have shadowed a shared server of the same name
+    if name in _mcp_pools:
+        await attach_shared_mcp_server(_mcp_pools[name])
+
+def get_tool_timeout(tool_name):
+    """Return the deadline in seconds for a single call of the given tool"""
+    return float(TOOL_CALL_TIMEOUTS.get(tool_name, TOOL_CALL_TIMEOUT_SECONDS))
+
+def get_connection_semaphore(mcp_name):
+    """Return this session's semaphore limiting concurrent tool calls on one MCP connection"""
+    semaphores = cl.user_session.get("mcp_tool_semaphores")
+    if not semaphores:
+        semaphores = {}
+        cl.user_session.set("mcp_tool_semaphores", semaphores)
+    if mcp_name not in semaphores:
+        semaphores[mcp_name] = asyncio.Semaphore(MAX_CONCURRENT_TOOL_CALLS_PER_CONNECTION)
+    return semaphores[mcp_name]
+
+def canonical_arguments(tool_input):
+    """Serialize tool arguments deterministically so equal calls compare equal"""
+    return json.dumps(tool_input, sort_keys=True, separators=(",", ":"), default=str)
+
+def is_read_only_tool(tool_name, tool_schema):
+    """A tool is read-only if listed in READ_ONLY_TOOLS or annotated with readOnlyHint"""
+    return tool_name in READ_ONLY_TOOLS or bool(tool_schema and tool_schema.get("read_only"))
+
+def is_tool_result_cacheable(tool_name, tool_schema):
+    if not TOOL_RESULT_CACHE_ENABLED:
+        return False
+    return tool_name in TOOL_RESULT_CACHE_TOOLS or is_read_only_tool(tool_name, tool_schema)
+
+def get_tool_result_cache():
+    """Return this session's LRU cache of (connection, tool, arguments) -> (expires_at, result)"""
+    cache = cl.user_session.get("tool_result_cache")
+    if cache is None:
+        cache = OrderedDict()
+        cl.user_session.set("tool_result_cache", cache)
+    return cache
+
+def get_cached_tool_result(key):
+    cache = get_tool_result_cache()
+    entry = cache.get(key)
+    if entry and entry[0] > time.monotonic():
+        cache.move_to_end(key)
+        tool_result_cache_stats["hits"] += 1
+        return entry[1]
+    if entry:
+        del cache[key]
+    tool_result_cache_stats["misses"] += 1
+    return None
+
+def store_tool_result(key, tool_name, result_text):
+    cache = get_tool_result_cache()
+    ttl = float(TOOL_RESULT_CACHE_TTLS.get(tool_name, TOOL_RESULT_CACHE_TTL_SECONDS))
+    cache[key] = (time.monotonic() + ttl, result_text)
+    cache.move_to_end(key)
+    while len(cache) > TOOL_RESULT_CACHE_SIZE:
+        cache.popitem(last=False)
+        tool_result_cache_stats["evictions"] += 1
+
+def process_tool_output(tool_output, tool_name):
+    """Turn an MCP tool result into the text sent back to the model.
+
+    All text parts are joined once; other content types are noted but not inlined.
+    Text over TOOL_OUTPUT_MAX_CHARS is cut to its head and tail around a marker,
+    and the full text is attached to the current tool step for the user to open.
+    """
+    if not hasattr(tool_output, 'content') or not tool_output.content:
+        # Fallback if content is not available
+        return "Unable to retrieve tables"
+
+    parts = []
+    for item in tool_output.content:
+        if hasattr(item, 'text'):
+            parts.append(item.text)
+        else:
+            parts.append(f"[{getattr(item, 'type', 'unknown')} content omitted]")
+    result_text = "\n".join(parts)
+
+    if len(result_text) <= TOOL_OUTPUT_MAX_CHARS:
+        return result_text
+
+    saved = "full output not kept"
+    step = cl.context.current_step
+    if step is not None:
+        file_name = f"{tool_name}-output-{uuid.uuid4().hex[:8]}.txt"
+        step.elements = (step.elements or []) + [
+            cl.File(name=file_name, content=result_text, mime="text/plain", display="inline")
+        ]
+        saved = f"full output attached to the tool call as {file_name}"
+    keep = TOOL_OUTPUT_MAX_CHARS // 2
+    omitted = len(result_text) - 2 * keep
+    return f"{result_text[:keep]}\n... [truncated {omitted} characters; {saved}] ...\n{result_text[-keep:]}"
+
+async def execute_tool(mcp_session, mcp_name, tool_name, tool_input):
+    """Run one MCP tool call under the connection's concurrency limit and deadline.
+
+    Returns the result text for the model and a status of "ok", "timeout" or "error".
+    """
+    timeout = get_tool_timeout(tool_name)
+    started = time.monotonic()
+    status = "ok"
+    try:
+        # Call the tool with validated input, waiting for a free slot on the connection
+        async with get_connection_semaphore(mcp_name):
+            tool_output = await asyncio.wait_for(mcp_session.call_tool(tool_name, tool_input), timeout)
+
+        result_text = process_tool_output(tool_output, tool_name)
+        # The server ran the call but reported a failure; keep it out of caches and shared results
+        if getattr(tool_output, "isError", False):
+            logger.error(f"Tool {tool_name} on {mcp_name} returned an error")
+            status = "error"
+
+    except asyncio.TimeoutError:
+        # The straggler has been cancelled; tell the model so it can retry or move on
+        logger.error(f"Tool {tool_name} on {mcp_name} timed out after {timeout}s")
+        result_text = json.dumps({"error": "timeout", "tool": tool_name, "timeout_seconds": timeout})
+        status = "timeout"
+    except Exception as e:
+        # Handle and log any exceptions during tool execution
+        logger.error(f"Error calling tool {tool_name}: {str(e)}")
+        result_text = json.dumps({"error": str(e)})  # Send error back to OpenAI
+        status = "error"
+
+    TOOL_CALL_DURATION.observe(time.monotonic() - started, connection=mcp_name, tool=tool_name, status=status)
+    return result_text, status
+
 @cl.step(type="tool")
-async def call_tool(tool_call):
+@traced("call_tool")
+async def call_tool(tool_call, connection_name=None):
     # Get tool name from the function call
     tool_name = tool_call.function.name
     
-    # Add validation to handle empty or invalid arguments
-    try:
-        if not hasattr(tool_call.function, 'arguments') or not tool_call.function.arguments or tool_call.function.arguments.strip() == "":
-            tool_input = {}  # Default to empty dict if no arguments
-            # logger.info(f"Empty arguments for tool {tool_name}, using empty dict")
-        else:
-            tool_input = json.loads(tool_call.function.arguments)
-    except json.JSONDecodeError:
-        # Log the problematic value
-        logger.error(f"Invalid JSON in arguments: '{tool_call.function.arguments}'")
-        # For some tools, you might be able to infer the needed structure
-        if tool_name == "query_sql":
-            # Default structure for SQL queries - empty query will list tables
-            tool_input = {"sql": ""}
-        else:
-            tool_input = {}  # Use empty dict as fallback
+    # Parse the arguments; invalid JSON goes straight back to the model
+    arguments = getattr(tool_call.function, 'arguments', None) or ""
+    argument_errors = []
+    if not arguments.strip():
+        tool_input = {}  # Default to empty dict if no arguments
+    else:
+        try:
+            tool_input = json.loads(arguments)
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in arguments: '{arguments}'")
+            tool_input = arguments
+            argument_errors = [f"$: arguments are not valid JSON ({e.msg} at position {e.pos})"]
 
     current_step = cl.context.current_step
     current_step.name = tool_name
     current_step.input = tool_input  # Log the parsed input
 
     # Identify which mcp is used
-    mcp_tools_data = cl.user_session.get("mcp_tools_data", {})  # Use raw data for lookup
-    mcp_name = None
-
-    for connection_name, tools in mcp_tools_data.items():
-        if any(tool.get("name") == tool_name for tool in tools):
-            mcp_name = connection_name
-            break
+    tool_index = cl.user_session.get("mcp_tool_index") or {}
+    mcp_name, tool_schema = tool_index.get(tool_name, (None, None))
+    if connection_name:
+        # Tool buttons name their connection, which need not own a duplicated tool name
+        connection_tools = (cl.user_session.get("mcp_tools_data") or {}).get(connection_name, ())
+        tool_schema = next((tool for tool in connection_tools if tool["name"] == tool_name), None)
+        mcp_name = connection_name if tool_schema else None
 
     if not mcp_name:
         error_msg = json.dumps({"error": f"Tool {tool_name} not found in any MCP connection"})
         current_step.output = error_msg
         return {"tool_call_id": tool_call.id, "name": tool_name, "output": error_msg}
 
-    # Get MCP session with better error handling
+    # Check the arguments against the tool's compiled input schema before any MCP round trip
+    if not argument_errors:
+        validator = (cl.user_session.get("mcp_tool_validators") or {}).get(mcp_name, {}).get(tool_name)
+        if validator:
+            argument_errors = validator(tool_input)
+    if argument_errors:
+        error_msg = json.dumps({"error": "invalid arguments", "tool": tool_name, "details": argument_errors[:10]})
+        current_step.output = error_msg
+        return {"tool_call_id": tool_call.id, "name": tool_name, "output": error_msg}
+
+    # Get MCP session with better error handling; shared servers have no per-session
+    # connection and are called through their process-wide pool
     session_tuple = cl.context.session.mcp_sessions.get(mcp_name)
-    if not session_tuple:
+    if session_tuple:
+        mcp_session, _ = session_tuple
+    elif mcp_name in _mcp_pools:
+        mcp_session = _mcp_pools[mcp_name].session_for(cl.context.session.id)
+    else:
         error_msg = json.dumps({"error": f"MCP session for {mcp_name} not found"})
         current_step.output = error_msg
         return {"tool_call_id": tool_call.id, "name": tool_name, "output": error_msg}
 
-    mcp_session, _ = session_tuple
+    cache_key = None
+    if is_tool_result_cacheable(tool_name, tool_schema):
+        cache_key = (mcp_name, tool_name, canonical_arguments(tool_input))
+        cached_result = get_cached_tool_result(cache_key)
+        if cached_result is not None:
+            current_step.name = f"{tool_name} (cached)"
+            # The step shows where the result came from; the model gets the result as stored
+            current_step.output = f"(cached result)\n{cached_result}"
+            return {
+                "tool_call_id": tool_call.id,
+                "name": tool_name,
+                "output": cached_result
+            }
 
-    try:
-        # Call the tool with validated input
-        tool_output = await mcp_session.call_tool(tool_name, tool_input)
-
-        # Extract the content field which contains TextContent objects
-        if hasattr(tool_output, 'content') and tool_output.content:
-            # Find the TextContent object
-            for item in tool_output.content:
-                if hasattr(item, 'text'):
-                    # This is what we want - just the table names text
-                    result_text = item.text
-                    break
-            else:
-                # If we didn't find a TextContent with text attribute
-                result_text = "No tables found"
+    set_span_attributes(tool=tool_name, connection=mcp_name)
+    flight_key = None
+    if SINGLE_FLIGHT_ENABLED and is_read_only_tool(tool_name, tool_schema):
+        server_key = (cl.user_session.get("mcp_server_keys") or {}).get(mcp_name) or (cl.context.session.id, mcp_name)
+        flight_key = (server_key, tool_name, canonical_arguments(tool_input))
+
+    # An identical call may already be running; share its result under our own tool_call_id.
+    # A leader that is cancelled (its chat stopped or ended) resolves to None and the
+    # first follower to wake up takes over as the new leader
+    shared = None
+    while flight_key and shared is None and flight_key in _in_flight_tool_calls:
+        shared = await asyncio.shield(_in_flight_tool_calls[flight_key])
+
+    if shared is not None:
+        result_text, status = shared
+        if status == "ok":
+            single_flight_stats["coalesced"] += 1
+            current_step.name = f"{tool_name} (shared)"
         else:
-            # Fallback if content is not available
-            result_text = "Unable to retrieve tables"
-        
-    except Exception as e:
-        # Handle and log any exceptions during tool execution
-        logger.error(f"Error calling tool {tool_name}: {str(e)}")
-        error_msg = json.dumps({"error": str(e)})
-        current_step.output = error_msg
-        result_text = error_msg  # Send error back to OpenAI
+            # Failures are not shared; the error may be specific to the leader's attempt
+            result_text, status = await execute_tool(mcp_session, mcp_name, tool_name, tool_input)
+    else:
+        if flight_key:
+            leader = asyncio.get_running_loop().create_future()
+            _in_flight_tool_calls[flight_key] = leader
+            single_flight_stats["leaders"] += 1
+        result = None
+        try:
+            result = await execute_tool(mcp_session, mcp_name, tool_name, tool_input)
+        finally:
+            if flight_key:
+                del _in_flight_tool_calls[flight_key]
+                leader.set_result(result)
+        result_text, status = result
+
+    if status != "ok":
+        current_step.output = result_text
+    if cache_key and status == "ok":
+        store_tool_result(cache_key, tool_name, result_text)
 
     # Return format expected by OpenAI for tool results
     return {
         "tool_call_id": tool_call.id, 
         "name": tool_name, 
-        "output": json.dumps(result_text)
+        "output": result_text
     }
 
-async def get_openai_client(api_key):
-    """Creates a new OpenAI client with the given API key."""
+async def _close_client_entry(entry):
+    try:
+        await entry[0].close()
+    except Exception as e:
+        logger.warning(f"Error closing OpenAI client: {e}")
+
+async def _close_openai_client(user_id):
+    """Remove a client from the pool; its HTTP connections close once no stream still uses it"""
+    entry = _openai_clients.pop(user_id)
+    entry[3] = True
+    openai_client_stats["evictions"] += 1
+    if entry[2] == 0:
+        await _close_client_entry(entry)
+
+def preload_openai():
+    """Import the OpenAI SDK in a worker thread so the first request does not block the event loop on it"""
+    global _openai_import
+    if _openai_import is None or _openai_import.get_loop() is not asyncio.get_running_loop():
+        # An empty context, so the process-wide task does not keep the first session alive
+        _openai_import = asyncio.get_running_loop().create_task(
+            asyncio.to_thread(importlib.import_module, "openai"), context=contextvars.Context()
+        )
+    return _openai_import
+
+async def _get_openai_client_entry(api_key):
     if not api_key:
         raise ValueError("API Key is required to make requests")
-    
-    return openai.AsyncOpenAI(
-        base_url="https://openrouter.ai/api/v1",
+
+    now = time.monotonic()
+    # Least recently used clients sit at the front, so idle ones can be dropped from there
+    while _openai_clients:
+        oldest_id, oldest = next(iter(_openai_clients.items()))
+        if now - oldest[1] < OPENAI_CLIENT_IDLE_SECONDS:
+            break
+        await _close_openai_client(oldest_id)
+
+    user_id = get_user_id_from_api_key(api_key)
+    entry = _openai_clients.get(user_id)
+    if entry and entry[0].api_key == api_key:
+        entry[1] = now
+        _openai_clients.move_to_end(user_id)
+        openai_client_stats["hits"] += 1
+        return entry
+
+    if entry:
+        await _close_openai_client(user_id)
+    openai_client_stats["misses"] += 1
+
+    # The client keeps its own keep-alive connection pool, so reusing it avoids
+    # a new TCP/TLS handshake on every iteration of the tool loop
+    await preload_openai()
+    import openai
+    client = openai.AsyncOpenAI(
+        base_url=OPENROUTER_BASE_URL,
         api_key=api_key,
     )
+    entry = _openai_clients[user_id] = [client, now, 0, False]
+
+    while len(_openai_clients) > OPENAI_CLIENT_POOL_SIZE:
+        await _close_openai_client(next(iter(_openai_clients)))
+
+    return entry
+
+async def get_openai_client(api_key):
+    """Return a pooled OpenAI client for the given API key, creating one if needed."""
+    return (await _get_openai_client_entry(api_key))[0]
+
+@contextlib.asynccontextmanager
+async def use_openai_client(api_key):
+    """Hold a pooled client for one request so eviction cannot close it mid-stream"""
+    entry = await _get_openai_client_entry(api_key)
+    entry[2] += 1
+    try:
+        yield entry[0]
+    finally:
+        entry[2] -= 1
+        entry[1] = time.monotonic()
+        if entry[3] and entry[2] == 0:
+            await _close_client_entry(entry)
+
+def select_tools(tools_payload, chat_messages):
+    """Pick the tool positions to send for this request, or None to send every tool.
+
+    Tools are ranked with BM25 against the last few user/assistant messages; the
+    top TOOL_SELECTION_TOP_K plus recently used tools are kept in catalog order.
+    The choice is kept for the rest of the user message, so every tool-loop
+    iteration sends the same tools prefix and reuses the provider's prompt cache.
+    """
+    search_index = tools_payload.get("search_index")
+    if not search_index or TOOL_SELECTION_TOP_K <= 0 or cl.user_session.get("send_all_tools"):
+        return None
+    previous = cl.user_session.get("tool_selection")
+    if previous and previous[0] == tools_payload["version"]:
+        return previous[1]
+
+    context = []
+    for message in reversed(chat_messages):
+        if message.get("role") in ("user", "assistant") and message.get("content"):
+            context.append(message["content"])
+            if len(context) >= TOOL_SELECTION_CONTEXT_MESSAGES:
+                break
+    scores = {}
+    for term in set(tokenize(" ".join(context))):
+        for position, weight in search_index.get(term, ()):
+            scores[position] = scores.get(position, 0) + weight
+    selected = set(sorted(scores, key=scores.get, reverse=True)[:TOOL_SELECTION_TOP_K])
+
+    recent_tools = set(cl.user_session.get("recent_tools") or [])
+    if recent_tools:
+        for position, tool in enumerate(tools_payload["tools"]):
+            if tool["function"]["name"] in recent_tools:
+                selected.add(position)
+    # Nothing matched and nothing was used recently: better the full set than no tools
+    selection = sorted(selected) if selected else None
+    cl.user_session.set("tool_selection", (tools_payload["version"], selection))
+    return selection
+
+def remember_used_tools(tool_calls, sent_tool_names):
+    """Track recently used tools and fall back to the full catalog if the model asked for an unsent one"""
+    recent_tools = cl.user_session.get("recent_tools") or []
+    for tool_call in tool_calls:
+        name = tool_call["function"]["name"]
+        if name in recent_tools:
+            recent_tools.remove(name)
+        recent_tools.append(name)
+        if sent_tool_names is not None and name not in sent_tool_names:
+            logger.info(f"Model requested unsent tool {name}; sending the full tool set for this message")
+            cl.user_session.set("send_all_tools", True)
+    cl.user_session.set("recent_tools", recent_tools[-TOOL_SELECTION_RECENT_TOOLS:])
+
+def apply_model_catalog(catalog_data):
+    """Use OpenRouter /models metadata to decide which of OPENROUTER_MODELS are offered"""
+    global model_catalog, AVAILABLE_MODELS, OPENROUTER_MODEL_INDEX
+    model_catalog = {model["id"]: model for model in catalog_data.get("data", [])}
+    listed = [model for model in OPENROUTER_MODELS if model in model_catalog]
+    AVAILABLE_MODELS = listed or list(OPENROUTER_MODELS)
+    OPENROUTER_MODEL_INDEX = {model: index for index, model in enumerate(AVAILABLE_MODELS)}
+    build_settings_widgets.cache_clear()
+
+def load_model_catalog():
+    """Load the cached model catalog from disk, if present"""
+    if not os.path.exists(MODEL_CATALOG_PATH):
+        return
+    try:
+        with open(MODEL_CATALOG_PATH, 'r') as f:
+            apply_model_catalog(json.load(f))
+    except (json.JSONDecodeError, OSError) as e:
+        logger.error(f"Error loading model catalog {MODEL_CATALOG_PATH}: {e}")
+
+def save_model_catalog(catalog_data):
+    with open(MODEL_CATALOG_PATH, 'w') as f:
+        json.dump(catalog_data, f)
+
+async def refresh_model_catalog():
+    """Fetch OpenRouter model metadata every MODEL_CATALOG_REFRESH_SECONDS"""
+    import httpx
+    while True:
+        try:
+            async with httpx.AsyncClient(timeout=30) as http:
+                response = await http.get(f"{OPENROUTER_BASE_URL}/models")
+                response.raise_for_status()
+                catalog_data = response.json()
+            await asyncio.to_thread(save_model_catalog, catalog_data)
+            apply_model_catalog(catalog_data)
+            logger.info(f"Refreshed model catalog: {len(model_catalog)} models")
+        except Exception as e:
+            logger.warning(f"Error refreshing model catalog: {e}")
+        await asyncio.sleep(MODEL_CATALOG_REFRESH_SECONDS)
+
+def ensure_model_catalog_refresh():
+    """Start the background catalog refresh once per process"""
+    global _model_catalog_task
+    if MODEL_CATALOG_REFRESH_SECONDS > 0 and _model_catalog_task is None:
+        _model_catalog_task = asyncio.get_running_loop().create_task(
+            refresh_model_catalog(), context=contextvars.Context()
+        )
+
+def model_error_rate(model, now=None):
+    """Return a model's rolling error rate, decayed for the time since its last sample"""
+    health = model_health.get(model)
+    if not health:
+        return 0.0
+    if MODEL_ERROR_HALF_LIFE_SECONDS <= 0:
+        return health["error_rate"]
+    age = (now if now is not None else time.monotonic()) - health["updated_at"]
+    return health["error_rate"] * 0.5 ** (age / MODEL_ERROR_HALF_LIFE_SECONDS)
+
+def record_model_result(model, ttft=None, error=False):
+    """Update the rolling time-to-first-token and error-rate estimates for a model"""
+    now = time.monotonic()
+    if model not in model_health and len(model_health) >= MODEL_HEALTH_MAX_MODELS:
+        return
+    health = model_health.setdefault(model, {"ttft": None, "error_rate": 0.0, "samples": 0, "updated_at": now})
+    error_rate = model_error_rate(model, now)
+    health["samples"] += 1
+    health["error_rate"] = error_rate + MODEL_HEALTH_ALPHA * ((1.0 if error else 0.0) - error_rate)
+    health["updated_at"] = now
+    if ttft is not None:
+        health["ttft"] = ttft if health["ttft"] is None else health["ttft"] + MODEL_HEALTH_ALPHA * (ttft - health["ttft"])
+
+def plan_models(selected):
+    """Return the models to try, in order, for one request"""
+    models = [selected]
+    if MODEL_ROUTING == "fastest":
+        candidates = [selected] + [m for m in MODEL_ROUTING_CANDIDATES if m != selected]
+        now = time.monotonic()
+        healthy = [m for m in candidates if model_error_rate(m, now) < MODEL_MAX_ERROR_RATE]
+        # Models without samples yet sort after measured ones, keeping the selected model first among them
+        models = sorted(healthy, key=lambda m: (model_health.get(m, {}).get("ttft") is None, model_health.get(m, {}).get("ttft") or 0)) or [selected]
+    if MODEL_FALLBACK and MODEL_FALLBACK not in models:
+        models.append(MODEL_FALLBACK)
+    return models
+
+async def open_model_stream(client, api_args, models):
+    """Start a streamed completion, moving to the next model on timeout, 429 or 5xx.
+
+    Returns the model used, when its request started, its first chunk (or None
+    for an empty stream) and the iterator over the remaining chunks. The
+    first-chunk timeout only applies while there is another model to fall back to.
+    """
+    import openai
+
+    async def first_chunk_of(attempt_client, model):
+        stream_resp = await attempt_client.chat.completions.create(**{**api_args, "model": model})
+        chunks = stream_resp.__aiter__()
+        try:
+            return chunks, await chunks.__anext__()
+        except StopAsyncIteration:
+            return chunks, None
+        except BaseException:
+            # Timed out or failed mid-stream: release the connection instead of leaving it open
+            await stream_resp.close()
+            raise
+
+    for attempt, model in enumerate(models):
+        last = attempt == len(models) - 1
+        # The SDK's own retries would delay the fallback, so only the last attempt keeps them
+        attempt_client = client if last else client.with_options(max_retries=0)
+        started = time.monotonic()
+        try:
+            if last:
+                chunks, first_chunk = await first_chunk_of(attempt_client, model)
+            else:
+                chunks, first_chunk = await asyncio.wait_for(
+                    first_chunk_of(attempt_client, model), LLM_FIRST_CHUNK_TIMEOUT_SECONDS
+                )
+        except (asyncio.TimeoutError, openai.APITimeoutError, openai.APIConnectionError,
+                openai.RateLimitError, openai.InternalServerError) as e:
+            record_model_result(model, error=True)
+            if last:
+                raise
+            logger.warning(f"Model {model} failed ({type(e).__name__}); falling back to {models[attempt + 1]}")
+            LLM_FALLBACKS.inc(model=model)
+            continue
+        record_model_result(model, ttft=time.monotonic() - started)
+        return model, started, first_chunk, chunks
+
+async def chain_chunks(first_chunk, chunks):
+    if first_chunk is not None:
+        yield first_chunk
+    async for chunk in chunks:
+        yield chunk
+
+def with_cache_breakpoint(message):
+    """Return a copy of a message whose text content carries an ephemeral cache_control hint"""
+    content = message.get("content")
+    if not isinstance(content, str) or not content:
+        return message
+    return {**message, "content": [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]}
+
+def build_api_messages(model, chat_messages):
+    """Prefix the system prompt and, for models that support it, mark cache breakpoints.
+
+    The breakpoints sit after the static system prompt (which follows the tools) and
+    on the newest message, so each tool-loop iteration reuses the previous prefix.
+    """
+    system_message = {"role": "system", "content": SYSTEM}
+    if not model or not model.startswith(PROMPT_CACHE_MODEL_PREFIXES):
+        return [system_message] + chat_messages
+    messages = [with_cache_breakpoint(system_message)] + chat_messages
+    if chat_messages:
+        messages[-1] = with_cache_breakpoint(messages[-1])
+    return messages
+
+class CoalescingStreamWriter:
+    """Buffer streamed tokens and emit them to a Chainlit message in batches.
+
+    The full response is kept as a list of parts and joined once at the end,
+    instead of growing a string on every chunk.
+    """
+
+    def __init__(self, msg, flush_ms=DEFAULT_STREAM_FLUSH_MS, flush_chars=STREAM_FLUSH_CHARS):
+        self.msg = msg
+        self.flush_seconds = flush_ms / 1000
+        self.flush_chars = flush_chars
+        self.parts = []
+        self.pending = []
+        self.pending_chars = 0
+        self.last_flush = time.monotonic()
+        self.emits = 0
+
+    async def write(self, token):
+        self.parts.append(token)
+        self.pending.append(token)
+        self.pending_chars += len(token)
+        if self.pending_chars >= self.flush_chars or time.monotonic() - self.last_flush >= self.flush_seconds:
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        await self.msg.stream_token("".join(self.pending))
+        self.pending = []
+        self.pending_chars = 0
+        self.last_flush = time.monotonic()
+        self.emits += 1
+
+    def text(self):
+        return "".join(self.parts)
+
+class ToolCallAssembler:
+    """Rebuild streamed tool calls and hand each one off as soon as it is complete.
+
+    A call is complete once a later call starts or once its arguments parse as a
+    JSON object. Nesting depth and string state are tracked as fragments arrive,
+    so every character is scanned once and the arguments are only parsed when
+    the top-level object closes; assembly stays linear in the size of the arguments.
+    """
+
+    def __init__(self, on_complete=None):
+        self.on_complete = on_complete
+        self.calls = []
+        self.argument_parts = []
+        self.completed = []
+        self.scan_states = []  # per call: [nesting depth, inside a string, after a backslash]
+        self.first_pending = 0
+
+    def add(self, fragment):
+        index = fragment.index
+        while index >= len(self.calls):
+            self.calls.append({"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+            self.argument_parts.append([])
+            self.completed.append(False)
+            self.scan_states.append([0, False, False])
+
+        # Models emit calls in order, so every earlier call is finished
+        while self.first_pending < index:
+            self._complete(self.first_pending)
+            self.first_pending += 1
+
+        call = self.calls[index]
+        if fragment.id:
+            call["id"] = fragment.id
+        if fragment.function:
+            if fragment.function.name:
+                call["function"]["name"] = fragment.function.name
+            if fragment.function.arguments:
+                self.argument_parts[index].append(fragment.function.arguments)
+                if not self.completed[index] and self._closes_object(index, fragment.function.arguments):
+                    try:
+                        if isinstance(json.loads("".join(self.argument_parts[index])), dict):
+                            self._complete(index)
+                    except json.JSONDecodeError:
+                        pass
+
+    def _closes_object(self, index, text):
+        """Advance the call's scan over a new fragment; True if a top-level value just closed"""
+        state = self.scan_states[index]
+        depth, in_string, escaped = state
+        closed = False
+        for char in text:
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char in "{[":
+                depth += 1
+            elif char in "}]":
+                depth -= 1
+                closed = depth == 0
+        state[:] = depth, in_string, escaped
+        return closed
+
+    def finish(self):
+        """Complete any remaining calls and return them all in OpenAI format"""
+        for index in range(len(self.calls)):
+            self._complete(index)
+            self.calls[index]["function"]["arguments"] = "".join(self.argument_parts[index])
+        return self.calls
+
+    def _complete(self, index):
+        if self.completed[index]:
+            return
+        self.completed[index] = True
+        self.calls[index]["function"]["arguments"] = "".join(self.argument_parts[index])
+        if self.on_complete:
+            self.on_complete(self.calls[index])
+
+def to_tool_call(tool_call_dict):
+    """Wrap an OpenAI-format tool call dict so call_tool can use attribute access"""
+    return SimpleNamespace(
+        id=tool_call_dict["id"],
+        type=tool_call_dict.get("type", "function"),
+        function=SimpleNamespace(**tool_call_dict["function"]),
+    )
 
-async def call_llm(chat_messages, api_key):
+@traced("call_llm")
+async def call_llm(chat_messages, api_key, dispatch_tool=None):
+    """Stream one model response; dispatch_tool is called with each tool call as soon as it is complete"""
     msg = cl.Message(content="")
-    mcp_openai_tools = cl.user_session.get("mcp_openai_tools", {})
-    # Flatten the OpenAI-formatted tools from all MCP connections
-    tools = flatten([tools for _, tools in mcp_openai_tools.items()])
+    # Reuse the tools list flattened when the connection set last changed
+    tools_payload = cl.user_session.get("mcp_tools_payload") or refresh_tools_payload(
+        cl.user_session.get("mcp_openai_tools") or {}
+    )
 
     # Get settings
     settings = cl.user_session.get("settings", {})
     model = settings.get("Model")
     temperature = float(settings.get("Temperature", 0))
+    flush_ms = int(settings.get("StreamFlushMs", DEFAULT_STREAM_FLUSH_MS))
+
+    tools = tools_payload["tools"]
+    tools_bytes = tools_payload["size_bytes"]
+    sent_tool_names = None
+    selected = select_tools(tools_payload, chat_messages)
+    if selected is not None:
+        tools = [tools[position] for position in selected]
+        tools_bytes = sum(tools_payload["tool_sizes"][position] for position in selected) + len(tools) + 1
+        sent_tool_names = {tool["function"]["name"] for tool in tools}
 
     # Prepare arguments for OpenAI API call
     api_args = {
         "model": model,
-        "messages": [
-                     {
-                      "role": "system", 
-                      "content": SYSTEM
-                      }
-                     ] + chat_messages,
+        "messages": build_api_messages(model, chat_messages),
         "temperature": temperature,
         "stream": True,
+        "stream_options": {"include_usage": True},
     }
     if tools:
         api_args["tools"] = tools
         api_args["tool_choice"] = "auto"
+        tool_schema_stats["requests"] += 1
+        tool_schema_stats["bytes_sent"] += tools_bytes
+        logger.debug(f"Sending {len(tools)} tools ({tools_bytes} bytes, version {tools_payload['version']})")
 
-    # Make the API call with the provided API key for this request
-    client = await get_openai_client(api_key)
-    stream_resp = await client.chat.completions.create(**api_args)
-
-    # Stream the response
-    full_response = ""
-    tool_calls = []
-    async for chunk in stream_resp:
-        delta = chunk.choices[0].delta
-        if delta.content:
-            full_response += delta.content
-            await msg.stream_token(delta.content)
-        if delta.tool_calls:
-            # Append tool call chunks to reconstruct the full tool call later
-            for tool_call_chunk in delta.tool_calls:
-                 # Initialize tool_calls entry if index doesn't exist
-                if tool_call_chunk.index >= len(tool_calls):
-                    tool_calls.append({"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
-
-                # Update the specific tool call entry
-                tc = tool_calls[tool_call_chunk.index]
-                if tool_call_chunk.id:
-                    tc["id"] = tool_call_chunk.id
-                if tool_call_chunk.function:
-                    if tool_call_chunk.function.name:
-                        tc["function"]["name"] = tool_call_chunk.function.name
-                    if tool_call_chunk.function.arguments:
-                        tc["function"]["arguments"] += tool_call_chunk.function.arguments
+    # Make the API call with the provided API key; the pooled client is held until
+    # the stream ends so pool eviction cannot close it under us
+    async with use_openai_client(api_key) as client:
+        model, started, first_chunk, stream_resp = await open_model_stream(client, api_args, plan_models(model))
+        set_span_attributes(model=model)
+        first_chunk_at = None
+        chunks = 0
+        usage = None
 
+        # Stream the response
+        writer = CoalescingStreamWriter(msg, flush_ms=flush_ms)
+        assembler = ToolCallAssembler(on_complete=dispatch_tool)
+        async for chunk in chain_chunks(first_chunk, stream_resp):
+            if chunk.usage:
+                usage = chunk.usage
+            # The usage chunk at the end of the stream carries no choices
+            if not chunk.choices:
+                continue
+            chunks += 1
+            if first_chunk_at is None:
+                first_chunk_at = time.monotonic()
+                LLM_TIME_TO_FIRST_TOKEN.observe(first_chunk_at - started, model=model)
+            delta = chunk.choices[0].delta
+            if delta.content:
+                await writer.write(delta.content)
+            if delta.tool_calls:
+                for tool_call_chunk in delta.tool_calls:
+                    assembler.add(tool_call_chunk)
+
+    tool_calls = assembler.finish()
+    if tool_calls:
+        remember_used_tools(tool_calls, sent_tool_names)
+    await writer.flush()
     await msg.update()
+    full_response = writer.text()
+
+    LLM_STREAM_DURATION.observe(time.monotonic() - started, model=model)
+    LLM_RESPONSE_CHUNKS.inc(chunks, model=model)
+    if usage:
+        LLM_RESPONSE_TOKENS.inc(usage.completion_tokens or 0, model=model)
+        LLM_PROMPT_TOKENS.inc(usage.prompt_tokens or 0, model=model)
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        LLM_CACHED_PROMPT_TOKENS.inc(cached_tokens, model=model)
+        logger.info(f"{model}: {usage.prompt_tokens} prompt tokens, {cached_tokens} from cache")
 
     # Construct the final assistant message object for history
     assistant_message = {"role": "assistant", "content": full_response}
@@ -475,9 +2187,244 @@ async def call_llm(chat_messages, api_key):
 
     return assistant_message
 
+def take_llm_rate_token(user_id):
+    """Take one call from the user's token bucket; return 0 if admitted, else seconds until one is free"""
+    if LLM_RATE_PER_MINUTE <= 0:
+        return 0
+    rate = LLM_RATE_PER_MINUTE / 60
+    now = time.monotonic()
+    bucket = _llm_rate_buckets.get(user_id)
+    if bucket is None:
+        if len(_llm_rate_buckets) > 10000:
+            # Full buckets carry no state worth keeping
+            for stale_id in [uid for uid, (tokens, last) in _llm_rate_buckets.items() if tokens + (now - last) * rate >= LLM_RATE_BURST]:
+                del _llm_rate_buckets[stale_id]
+        bucket = _llm_rate_buckets[user_id] = [LLM_RATE_BURST, now]
+    bucket[0] = min(LLM_RATE_BURST, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    if bucket[0] >= 1:
+        bucket[0] -= 1
+        return 0
+    return (1 - bucket[0]) / rate
+
+class FairStreamScheduler:
+    """Cap concurrent LLM streams and hand free slots to waiting users in round-robin order"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = OrderedDict()  # user_id -> deque of futures
+
+    def queue_depth(self):
+        return sum(len(queue) for queue in self.waiting.values())
+
+    async def acquire(self, user_id):
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(user_id, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been handed over just as we were cancelled
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiting:
+            user_id, queue = next(iter(self.waiting.items()))
+            future = queue.popleft()
+            if queue:
+                self.waiting.move_to_end(user_id)
+            else:
+                del self.waiting[user_id]
+            if not future.done():
+                # Pass the slot straight to the next user without freeing it
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_id):
+        await self.acquire(user_id)
+        try:
+            yield
+        finally:
+            self.release()
+
+llm_stream_scheduler = FairStreamScheduler(MAX_CONCURRENT_LLM_STREAMS)
+
+async def admit_llm_call(user_id):
+    """Wait for the user's rate limit; return False if the wait would exceed LLM_RATE_MAX_WAIT_SECONDS"""
+    while True:
+        wait = take_llm_rate_token(user_id)
+        if wait == 0:
+            return True
+        if wait > LLM_RATE_MAX_WAIT_SECONDS:
+            LLM_RATE_LIMITED.inc()
+            return False
+        await asyncio.sleep(wait)
+
+def touch_session():
+    """Record activity for the current session so it is not evicted as idle"""
+    _session_activity[cl.context.session.id] = time.monotonic()
+
+def release_session_state(session_data):
+    for key in EVICTABLE_SESSION_KEYS:
+        session_data.pop(key, None)
+
+def end_session(session_id):
+    """Forget a session whose user session Chainlit has cleared"""
+    if _session_activity.pop(session_id, None) is not None:
+        session_lifecycle_stats["ended"] += 1
+
+async def sweep_idle_sessions():
+    """Forget cleared sessions and release the heavy state of idle ones.
+
+    A websocket disconnect keeps the session for Chainlit's reconnect window, so a
+    session counts as ended only once its user session is gone from user_sessions.
+    """
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL_SECONDS)
+        cutoff = time.monotonic() - SESSION_IDLE_SECONDS
+        for session_id, last_active in list(_session_activity.items()):
+            session_data = user_sessions.get(session_id)
+            if session_data is None:
+                end_session(session_id)
+                continue
+            if SESSION_IDLE_SECONDS <= 0 or last_active >= cutoff:
+                continue
+            del _session_activity[session_id]
+            release_session_state(session_data)
+            session_lifecycle_stats["evicted"] += 1
+            logger.info(f"Released state of session {session_id} after {SESSION_IDLE_SECONDS}s idle")
+
+def ensure_session_sweeper():
+    """Start the session sweeper once per process"""
+    global _session_sweeper_task
+    if SESSION_SWEEP_INTERVAL_SECONDS > 0 and _session_sweeper_task is None:
+        _session_sweeper_task = asyncio.get_running_loop().create_task(
+            sweep_idle_sessions(), context=contextvars.Context()
+        )
+
+def trim_history(chat_messages):
+    """Drop the oldest turns once chat_messages exceeds MAX_HISTORY_MESSAGES.
+
+    The cut is made at a user message so no tool result loses its tool call, and
+    the cached token counts are trimmed alongside instead of being recomputed.
+    """
+    if MAX_HISTORY_MESSAGES <= 0 or len(chat_messages) <= MAX_HISTORY_MESSAGES:
+        return
+    excess = len(chat_messages) - MAX_HISTORY_MESSAGES
+    cut = next((i for i in range(1 + excess, len(chat_messages)) if chat_messages[i].get("role") == "user"), None)
+    if cut is None:
+        return
+    del chat_messages[1:cut]
+    removed = cut - 1
+    session_lifecycle_stats["trimmed_messages"] += removed
+
+    state = cl.user_session.get("history_state")
+    if state:
+        counts = state["counts"]
+        state["total"] -= sum(counts[1:cut])
+        del counts[1:cut]
+        state["cursor"] = max(1, state["cursor"] - removed)
+    # The state store keeps the full log; only the in-memory offset moves
+    persisted = cl.user_session.get("persisted_messages", 0)
+    if persisted:
+        cl.user_session.set("persisted_messages", max(0, persisted - removed))
+
+def estimate_tokens(message):
+    """Roughly estimate the tokens of a chat message (about 4 characters per token)"""
+    chars = len(message.get("content") or "")
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function", {})
+        chars += len(function.get("name", "")) + len(function.get("arguments", ""))
+    return chars // 4 + 4
+
+def compact_history(chat_messages):
+    """Keep the estimated size of chat_messages within HISTORY_TOKEN_BUDGET.
+
+    Token counts are cached per message in the user session, so each call only
+    counts messages added since the last one. When over budget, tool results older
+    than the latest user message are truncated oldest first; system and user turns
+    are never touched.
+    """
+    state = cl.user_session.get("history_state") or {"counts": [], "total": 0, "cursor": 0}
+    counts = state["counts"]
+    for message in chat_messages[len(counts):]:
+        tokens = estimate_tokens(message)
+        counts.append(tokens)
+        state["total"] += tokens
+
+    if state["total"] > HISTORY_TOKEN_BUDGET:
+        last_user = next((i for i in range(len(chat_messages) - 1, -1, -1) if chat_messages[i].get("role") == "user"), 0)
+        # Messages before the cursor have already been compacted
+        for i in range(state["cursor"], last_user):
+            if state["total"] <= HISTORY_TOKEN_BUDGET:
+                break
+            message = chat_messages[i]
+            content = message.get("content") or ""
+            if message.get("role") != "tool" or len(content) <= HISTORY_TRUNCATED_TOOL_CHARS:
+                state["cursor"] = i + 1
+                continue
+            removed = len(content) - HISTORY_TRUNCATED_TOOL_CHARS
+            message["content"] = content[:HISTORY_TRUNCATED_TOOL_CHARS] + f"... [truncated {removed} characters from earlier tool result]"
+            tokens = estimate_tokens(message)
+            state["total"] += tokens - counts[i]
+            counts[i] = tokens
+            state["cursor"] = i + 1
+        if state["total"] > HISTORY_TOKEN_BUDGET:
+            logger.warning(f"Chat history is ~{state['total']} tokens, above the {HISTORY_TOKEN_BUDGET} budget")
+
+    cl.user_session.set("history_state", state)
+    return state["total"]
+
+@functools.lru_cache(maxsize=64)
+def build_settings_widgets(model_index, temperature, tool_buttons, flush_ms):
+    """Build the settings panel widgets; cached because most sessions share the same initial values"""
+    return (
+        Select(
+            id="Model",
+            label="OpenRouter Model",
+            values=AVAILABLE_MODELS,
+            initial_index=model_index,
+        ),
+        Slider(
+            id="Temperature",
+            label="Temperature",
+            initial=temperature,
+            min=0,
+            max=2,
+            step=0.1,
+        ),
+        Switch(
+            id="CreateToolButtons",
+            label="Create Default Tool Calls",
+            initial=tool_buttons,
+        ),
+        Slider(
+            id="StreamFlushMs",
+            label="Stream Flush Interval (ms)",
+            initial=flush_ms,
+            min=0,
+            max=500,
+            step=10,
+        )
+    )
+
+load_model_catalog()
+
+# Prebuild the default panel so the first session does not pay for it
+build_settings_widgets(0, DEFAULT_TEMPERATURE, False, DEFAULT_STREAM_FLUSH_MS)
+
 @cl.on_chat_start
 async def start_chat():
-    
+    # Start loading the OpenAI SDK now, while the user is still typing
+    preload_openai()
+
     # Check if user has API key from localStorage and can restore preferences
     user_env = cl.user_session.get("env", {})
     
@@ -492,50 +2439,32 @@ async def start_chat():
     initial_model_index = 0
     initial_temp = DEFAULT_TEMPERATURE
     initial_tool_buttons = False  # Default to off
+    initial_flush_ms = DEFAULT_STREAM_FLUSH_MS
     
     # If API key available from localStorage, try to restore user preferences
     if api_key:
         user_id = get_user_id_from_api_key(api_key)
-        saved_settings = load_user_settings(user_id)
+        saved_settings = await load_user_settings(user_id)
         
         if saved_settings:
             # Find index of their preferred model
             preferred_model = saved_settings.get("Model", DEFAULT_MODEL)
-            if preferred_model in OPENROUTER_MODELS:
-                initial_model_index = OPENROUTER_MODELS.index(preferred_model)
+            initial_model_index = OPENROUTER_MODEL_INDEX.get(preferred_model, initial_model_index)
             initial_temp = saved_settings.get("Temperature", DEFAULT_TEMPERATURE)
             initial_tool_buttons = saved_settings.get("CreateToolButtons", False)
+            initial_flush_ms = saved_settings.get("StreamFlushMs", DEFAULT_STREAM_FLUSH_MS)
     
     # Create settings panel with restored or default values
     settings = await cl.ChatSettings(
-        [
-            Select(
-                id="Model",
-                label="OpenRouter Model",
-                values=OPENROUTER_MODELS,
-                initial_index=initial_model_index,
-            ),
-            Slider(
-                id="Temperature",
-                label="Temperature",
-                initial=initial_temp,
-                min=0,
-                max=2,
-                step=0.1,
-            ),
-            Switch(
-                id="CreateToolButtons",
-                label="Create Default Tool Calls",
-                initial=initial_tool_buttons,
-            )
-        ]
+        list(build_settings_widgets(initial_model_index, initial_temp, initial_tool_buttons, initial_flush_ms))
     ).send()
     
     # Store initial settings values in user session
     initial_settings = {
-        "Model": OPENROUTER_MODELS[initial_model_index],
+        "Model": AVAILABLE_MODELS[initial_model_index],
         "Temperature": initial_temp,
-        "CreateToolButtons": initial_tool_buttons               
+        "CreateToolButtons": initial_tool_buttons,
+        "StreamFlushMs": initial_flush_ms
     }
     cl.user_session.set("settings", initial_settings)
     
@@ -543,6 +2472,38 @@ async def start_chat():
     cl.user_session.set("chat_messages", [])
     cl.user_session.set("mcp_tools_data", {})
     cl.user_session.set("mcp_openai_tools", {})
+    cl.user_session.set("mcp_tool_index", {})
+    cl.user_session.set("mcp_tool_collisions", {})
+    cl.user_session.set("mcp_tools_payload", None)
+    cl.user_session.set("history_state", None)
+    await attach_shared_mcp_servers()
+
+    ensure_model_catalog_refresh()
+    ensure_session_sweeper()
+    touch_session()
+
+@cl.on_chat_end
+async def on_chat_end():
+    """Forget the session if the user cleared it.
+
+    This also runs on every websocket disconnect, while the client may still
+    reconnect to the same session, so otherwise its state is left alone and the
+    sweeper forgets it once Chainlit's session timeout clears it.
+    """
+    if cl.context.session.to_clear:
+        end_session(cl.context.session.id)
+
+@cl.on_chat_resume
+async def on_chat_resume(thread):
+    """Restore conversation state when a thread is resumed, possibly on another replica"""
+    cl.user_session.set("mcp_tools_data", {})
+    cl.user_session.set("mcp_openai_tools", {})
+    cl.user_session.set("mcp_tool_index", {})
+    cl.user_session.set("mcp_tool_collisions", {})
+    cl.user_session.set("mcp_tools_payload", None)
+    cl.user_session.set("history_state", None)
+    await attach_shared_mcp_servers()
+    await restore_chat_state()
 
 # Settings update handler
 @cl.on_settings_update
@@ -554,6 +2515,11 @@ async def on_settings_update(settings):
     
     # Update all settings in user session
     cl.user_session.set("settings", settings)
+    if state_store is not None:
+        try:
+            await state_store.set(state_key("settings"), settings)
+        except backend_errors() as e:
+            logger.error(f"Error saving chat settings: {e}")
     
     # If model changed and we have chat messages (not a new chat), show model selection message
     chat_messages = cl.user_session.get("chat_messages", [])
@@ -571,7 +2537,8 @@ async def on_settings_update(settings):
             user_prefs = {
                 "Model": settings.get("Model"),
                 "Temperature": settings.get("Temperature"),
-                "CreateToolButtons": settings.get("CreateToolButtons")
+                "CreateToolButtons": settings.get("CreateToolButtons"),
+                "StreamFlushMs": settings.get("StreamFlushMs")
             }
             save_user_settings(user_id, user_prefs)
     else:
@@ -584,10 +2551,22 @@ async def on_settings_update(settings):
                 user_prefs = {
                     "Model": settings.get("Model"),
                     "Temperature": settings.get("Temperature"),
-                    "CreateToolButtons": settings.get("CreateToolButtons")
+                    "CreateToolButtons": settings.get("CreateToolButtons"),
+                    "StreamFlushMs": settings.get("StreamFlushMs")
                 }
                 save_user_settings(user_id, user_prefs)
     
+async def load_chat_messages():
+    """Return this session's chat history, starting with the system message"""
+    if not cl.user_session.get("chat_messages"):
+        # Another replica may have served earlier turns of this thread
+        await restore_chat_state()
+    chat_messages = cl.user_session.get("chat_messages", [])
+
+    if not chat_messages or chat_messages[0].get("role") != "system":
+         chat_messages.insert(0, {"role": "system", "content": SYSTEM})
+    return chat_messages
+
 @cl.on_message
 async def on_message(msg: cl.Message):
     # Get API key from environment variables in user session
@@ -599,34 +2578,48 @@ async def on_message(msg: cl.Message):
         user_env = {}
 
     api_key = user_env.get("OPENROUTER_API_KEY")
-    chat_messages = cl.user_session.get("chat_messages", [])
+    touch_session()
+    chat_messages = await load_chat_messages()
     chat_messages.append({"role": "user", "content": msg.content})
 
-    if not chat_messages or chat_messages[0].get("role") != "system":
-         chat_messages.insert(0, {"role": "system", "content": SYSTEM})
-
+    cl.user_session.set("send_all_tools", False)
+    cl.user_session.set("tool_selection", None)
+    user_id = get_user_id_from_api_key(api_key) or cl.context.session.id
+    iterations = 0
     while True:
-        messages_for_api = [msg for msg in chat_messages if msg.get("role") != "system"]
-        assistant_message = await call_llm(messages_for_api, api_key)
-        chat_messages.append(assistant_message)
-
-        if not assistant_message.get("tool_calls"):
+        if iterations >= MAX_TOOL_LOOP_ITERATIONS:
+            logger.warning(f"Stopping tool loop for user {user_id} after {iterations} iterations")
+            await cl.Message(content=f"⚠️ Stopped after {iterations} model calls for this message.").send()
             break
+        iterations += 1
+        compact_history(chat_messages)
+        messages_for_api = [msg for msg in chat_messages if msg.get("role") != "system"]
 
+        # Tools start while the model is still streaming the rest of its response
         tool_tasks = []
-        for tool_call_dict in assistant_message["tool_calls"]:
-            class ToolCall:
-                def __init__(self, **kwargs):
-                    self.__dict__.update(kwargs)
-                    if 'function' in kwargs and isinstance(kwargs['function'], dict):
-                        self.function = type('Function', (), kwargs['function'])()
+        def dispatch_tool(tool_call_dict):
+            tool_tasks.append(asyncio.create_task(call_tool(to_tool_call(tool_call_dict))))
 
-            tool_call_obj = ToolCall(**tool_call_dict)
-            tool_tasks.append(call_tool(tool_call_obj))
+        queued_at = time.monotonic()
+        if not await admit_llm_call(user_id):
+            await cl.Message(content="⚠️ Rate limit reached, please wait a moment and try again.").send()
+            break
+        try:
+            async with llm_stream_scheduler.slot(user_id):
+                LLM_QUEUE_WAIT.observe(time.monotonic() - queued_at)
+                assistant_message = await call_llm(messages_for_api, api_key, dispatch_tool)
+        except BaseException:
+            for task in tool_tasks:
+                task.cancel()
+            raise
+        chat_messages.append(assistant_message)
 
-        tool_results = await asyncio.gather(*tool_tasks)
+        if not assistant_message.get("tool_calls"):
+            break
 
-        for result in tool_results:
+        # Record each result as soon as its tool finishes instead of waiting for the slowest one
+        for next_result in asyncio.as_completed(tool_tasks):
+             result = await next_result
              chat_messages.append({
                  "role": "tool",
                  "tool_call_id": result["tool_call_id"],
@@ -634,5 +2627,8 @@ async def on_message(msg: cl.Message):
                  "content": result["output"],
              })
 
+    MESSAGE_LOOP_ITERATIONS.observe(iterations)
     cl.user_session.set("chat_messages", chat_messages)
+    await persist_chat_messages(chat_messages)
+    trim_history(chat_messages)
 
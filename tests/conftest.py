@@ -0,0 +1,52 @@
+import asyncio
+import os
+import socket
+import sys
+import uuid
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_ROOT = os.path.join(REPO_ROOT, "chainlit_mcp_client")
+BENCH_ROOT = os.path.join(REPO_ROOT, "bench")
+os.environ.setdefault("CHAINLIT_APP_ROOT", APP_ROOT)
+sys.path.insert(0, APP_ROOT)
+# The benchmark stubs double as local servers for the tests
+sys.path.append(BENCH_ROOT)
+
+
+async def _noop_emit(*args, **kwargs):
+    pass
+
+
+@pytest.fixture
+def chat_session():
+    """A Chainlit websocket session set as the current context, so cl.user_session works"""
+    from chainlit.context import ChainlitContext, context_var
+    from chainlit.session import WebsocketSession
+    from chainlit.user_session import user_sessions
+
+    session = WebsocketSession(
+        id=str(uuid.uuid4()),
+        socket_id=str(uuid.uuid4()),
+        emit=_noop_emit,
+        emit_call=_noop_emit,
+        user_env={},
+        client_type="webapp",
+        thread_id=str(uuid.uuid4()),
+    )
+
+    async def create_context():
+        return ChainlitContext(session)
+
+    token = context_var.set(asyncio.run(create_context()))
+    yield session
+    context_var.reset(token)
+    user_sessions.pop(session.id, None)
+    asyncio.run(session.delete())
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
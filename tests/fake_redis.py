@@ -0,0 +1,127 @@
+"""A minimal Redis-protocol server for testing the Redis backends without Redis.
+
+Implements the commands the app uses (RPUSH, LRANGE, SET, GET, DEL, EXPIRE, HSET,
+HGET), the HELLO handshake for RESP2 or RESP3, and TTL for assertions. It runs on
+its own event loop in a thread so both the sync and the asyncio Redis clients can
+talk to it.
+"""
+import asyncio
+import threading
+import time
+
+
+class FakeRedisServer:
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.server = None
+
+    def start(self):
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self.handle, "127.0.0.1", 0), self.loop
+        ).result()
+        port = self.server.sockets[0].getsockname()[1]
+        return f"redis://127.0.0.1:{port}/0"
+
+    def stop(self):
+        async def close():
+            self.server.close()
+        asyncio.run_coroutine_threadsafe(close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def handle(self, reader, writer):
+        connection = {"proto": 2}
+        try:
+            while True:
+                command = await read_command(reader)
+                if command is None:
+                    break
+                command[0] = command[0].decode()
+                writer.write(self.execute(command, connection))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def live(self, key):
+        if key in self.expires and self.expires[key] <= time.monotonic():
+            self.data.pop(key, None)
+            del self.expires[key]
+        return self.data.get(key)
+
+    def execute(self, command, connection):
+        name, args = command[0].upper(), command[1:]
+        # RESP3 has its own null; every other reply here is the same in both protocols
+        null = b"_\r\n" if connection["proto"] == 3 else b"$-1\r\n"
+
+        def bulk(value):
+            return null if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+
+        if name == "HELLO":
+            connection["proto"] = int(args[0]) if args else 2
+            fields = b"".join(bulk(v) for v in (b"server", b"fake", b"version", b"7.0.0", b"proto"))
+            header = b"%3\r\n" if connection["proto"] == 3 else b"*6\r\n"
+            return header + fields + integer(connection["proto"])
+        if name in ("PING", "CLIENT", "SELECT"):
+            return b"+OK\r\n" if name != "PING" else b"+PONG\r\n"
+        if name == "RPUSH":
+            items = self.live(args[0])
+            if items is None:
+                items = self.data[args[0]] = []
+            items.extend(args[1:])
+            return integer(len(items))
+        if name == "LRANGE":
+            items = self.live(args[0]) or []
+            start, stop = int(args[1]), int(args[2])
+            values = items[start:None if stop == -1 else stop + 1]
+            return b"*%d\r\n" % len(values) + b"".join(bulk(value) for value in values)
+        if name == "SET":
+            self.data[args[0]] = args[1]
+            self.expires.pop(args[0], None)
+            if len(args) > 3 and args[2].upper() == b"EX":
+                self.expires[args[0]] = time.monotonic() + int(args[3])
+            return b"+OK\r\n"
+        if name == "GET":
+            return bulk(self.live(args[0]))
+        if name == "DEL":
+            removed = sum(self.data.pop(key, None) is not None for key in args)
+            return integer(removed)
+        if name == "EXPIRE":
+            if self.live(args[0]) is None:
+                return integer(0)
+            self.expires[args[0]] = time.monotonic() + int(args[1])
+            return integer(1)
+        if name == "TTL":
+            if self.live(args[0]) is None:
+                return integer(-2)
+            expires_at = self.expires.get(args[0])
+            return integer(-1 if expires_at is None else round(expires_at - time.monotonic()))
+        if name == "HSET":
+            fields = self.data.setdefault(args[0], {})
+            pairs = dict(zip(args[1::2], args[2::2]))
+            added = sum(field not in fields for field in pairs)
+            fields.update(pairs)
+            return integer(added)
+        if name == "HGET":
+            return bulk((self.live(args[0]) or {}).get(args[1]))
+        return f"-ERR unknown command '{name}'\r\n".encode()
+
+
+async def read_command(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    count = int(line[1:])
+    parts = []
+    for _ in range(count):
+        length = int((await reader.readline())[1:])
+        parts.append((await reader.readexactly(length + 2))[:-2])
+    return parts
+
+
+def integer(value):
+    return f":{value}\r\n".encode()
+
@@ -0,0 +1,63 @@
+import asyncio
+
+import app
+
+
+def test_rate_bucket_allows_a_burst_then_waits(monkeypatch):
+    monkeypatch.setattr(app, "LLM_RATE_PER_MINUTE", 60)
+    monkeypatch.setattr(app, "LLM_RATE_BURST", 3)
+    monkeypatch.setattr(app, "_llm_rate_buckets", {})
+    now = [1000.0]
+    monkeypatch.setattr(app.time, "monotonic", lambda: now[0])
+
+    assert [app.take_llm_rate_token("u") for _ in range(3)] == [0, 0, 0]
+    assert app.take_llm_rate_token("u") == 1.0
+    # Another user has a bucket of their own
+    assert app.take_llm_rate_token("v") == 0
+
+    now[0] += 1.0
+    assert app.take_llm_rate_token("u") == 0
+
+
+def test_rate_limit_can_be_disabled(monkeypatch):
+    monkeypatch.setattr(app, "LLM_RATE_PER_MINUTE", 0)
+    assert all(app.take_llm_rate_token("u") == 0 for _ in range(100))
+
+
+def test_scheduler_hands_slots_to_users_in_turn():
+    scheduler = app.FairStreamScheduler(limit=1)
+    order = []
+
+    async def turn(user_id, label):
+        async with scheduler.slot(user_id):
+            order.append(label)
+            await asyncio.sleep(0)
+
+    async def scenario():
+        await scheduler.acquire("holder")
+        # User a queues three turns before b queues two; b is not starved behind all of a's
+        tasks = [asyncio.create_task(turn("a", f"a{i}")) for i in range(3)]
+        tasks += [asyncio.create_task(turn("b", f"b{i}")) for i in range(2)]
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth() == 5
+        scheduler.release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert order == ["a0", "b0", "a1", "b1", "a2"]
+    assert scheduler.active == 0 and scheduler.queue_depth() == 0
+
+
+def test_cancelled_waiter_does_not_leak_a_slot():
+    scheduler = app.FairStreamScheduler(limit=1)
+
+    async def scenario():
+        await scheduler.acquire("holder")
+        waiter = asyncio.create_task(scheduler.acquire("a"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        scheduler.release()
+
+    asyncio.run(scenario())
+    assert scheduler.active == 0
@@ -0,0 +1,102 @@
+import asyncio
+
+import chainlit as cl
+from chainlit.user_session import user_sessions
+
+import app
+
+
+def conversation(turns, tool_chars):
+    messages = [{"role": "system", "content": "You are helpful"}]
+    for turn in range(turns):
+        messages += [
+            {"role": "user", "content": f"question {turn}"},
+            {"role": "assistant", "content": "", "tool_calls": [
+                {"id": f"call_{turn}", "type": "function", "function": {"name": "lookup", "arguments": "{}"}},
+            ]},
+            {"role": "tool", "tool_call_id": f"call_{turn}", "content": "x" * tool_chars},
+            {"role": "assistant", "content": f"answer {turn}"},
+        ]
+    return messages
+
+
+def test_compact_history_truncates_old_tool_results_oldest_first(chat_session, monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_TOKEN_BUDGET", 1000)
+    monkeypatch.setattr(app, "HISTORY_TRUNCATED_TOOL_CHARS", 100)
+    messages = conversation(3, 2000)
+    messages.append({"role": "user", "content": "latest question"})
+
+    total = app.compact_history(messages)
+
+    # Truncation stops as soon as the estimate is back under budget
+    tool_results = [m["content"] for m in messages if m["role"] == "tool"]
+    assert [content.startswith("x" * 100 + "... [truncated 1900 characters") for content in tool_results] == [True, True, False]
+    assert len(tool_results[2]) == 2000
+    assert messages[0]["content"] == "You are helpful" and messages[-1]["content"] == "latest question"
+    assert total == sum(app.estimate_tokens(m) for m in messages) <= 1000
+
+
+def test_compact_history_keeps_the_current_turn_and_counts_incrementally(chat_session, monkeypatch):
+    monkeypatch.setattr(app, "HISTORY_TOKEN_BUDGET", 100)
+    messages = conversation(1, 2000)
+
+    # The only tool result belongs to the latest user turn, so it is left whole
+    total = app.compact_history(messages)
+    assert len(messages[3]["content"]) == 2000
+    assert total == sum(app.estimate_tokens(m) for m in messages)
+
+    messages.append({"role": "user", "content": "next question"})
+    total = app.compact_history(messages)
+    assert len(cl.user_session.get("history_state")["counts"]) == len(messages)
+    assert total == sum(app.estimate_tokens(m) for m in messages)
+    assert len(messages[3]["content"]) < 2000
+
+
+def test_trim_history_cuts_at_a_user_message(chat_session, monkeypatch):
+    monkeypatch.setattr(app, "MAX_HISTORY_MESSAGES", 6)
+    messages = conversation(3, 10)
+    app.compact_history(messages)
+    cl.user_session.set("persisted_messages", len(messages))
+
+    app.trim_history(messages)
+
+    # 13 messages over a limit of 6: the first two turns go, the system prompt stays
+    assert [m["role"] for m in messages] == ["system", "user", "assistant", "tool", "assistant"]
+    assert messages[1]["content"] == "question 2"
+    state = cl.user_session.get("history_state")
+    assert state["counts"] == [app.estimate_tokens(m) for m in messages]
+    assert state["total"] == sum(state["counts"])
+    assert cl.user_session.get("persisted_messages") == len(messages)
+
+
+def test_trim_history_leaves_a_single_long_turn(chat_session, monkeypatch):
+    monkeypatch.setattr(app, "MAX_HISTORY_MESSAGES", 2)
+    messages = conversation(1, 10)
+    app.trim_history(messages)
+    assert len(messages) == 5
+
+
+def test_sweeper_ends_cleared_sessions_and_evicts_idle_ones(chat_session, monkeypatch):
+    monkeypatch.setattr(app, "SESSION_SWEEP_INTERVAL_SECONDS", 0.01)
+    monkeypatch.setattr(app, "SESSION_IDLE_SECONDS", 60)
+    monkeypatch.setattr(app, "_session_activity", {})
+    monkeypatch.setattr(app, "session_lifecycle_stats", {"evicted": 0, "ended": 0, "trimmed_messages": 0})
+
+    cl.user_session.set("tool_selection", (1, ["lookup"]))
+    cl.user_session.set("model", "stub/model")
+    app._session_activity[chat_session.id] = app.time.monotonic() - 120
+    app._session_activity["cleared-session"] = app.time.monotonic()
+    assert "cleared-session" not in user_sessions
+
+    async def sweep_once():
+        task = asyncio.create_task(app.sweep_idle_sessions())
+        await asyncio.sleep(0.05)
+        task.cancel()
+
+    asyncio.run(sweep_once())
+
+    assert app._session_activity == {}
+    assert app.session_lifecycle_stats["ended"] == 1
+    assert app.session_lifecycle_stats["evicted"] == 1
+    assert cl.user_session.get("tool_selection") is None
+    assert cl.user_session.get("model") == "stub/model"
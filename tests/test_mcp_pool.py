@@ -0,0 +1,71 @@
+import asyncio
+import json
+
+import pytest
+
+import app
+import stub_mcp
+from common import start_server
+from conftest import free_port
+
+
+@pytest.fixture
+def mcp_server_url():
+    port = free_port()
+    process = start_server(stub_mcp.serve, port, latency_ms=20, result_chars=40)
+    yield f"http://127.0.0.1:{port}/sse"
+    process.terminate()
+    process.join()
+
+
+@pytest.fixture
+def shared_servers(monkeypatch):
+    def configure(servers):
+        monkeypatch.setattr(app, "MCP_SHARED_SERVERS", servers)
+    monkeypatch.setattr(app, "_mcp_pools", {})
+    return configure
+
+
+def lookup_call(i):
+    return app.to_tool_call({
+        "id": f"call_{i}", "type": "function",
+        "function": {"name": "lookup", "arguments": json.dumps({"query": f"item {i}"})},
+    })
+
+
+def test_shared_server_is_called_without_a_session_connection(chat_session, mcp_server_url, shared_servers, monkeypatch):
+    monkeypatch.setattr(app, "MCP_POOL_SIZE", 2)
+    shared_servers({"shared": {"url": mcp_server_url}})
+    calls_before = app.mcp_pool_stats["calls"]
+
+    async def scenario():
+        await app.attach_shared_mcp_servers()
+        try:
+            return await asyncio.gather(*(app.call_tool(lookup_call(i)) for i in range(6)))
+        finally:
+            await app._mcp_pools["shared"].close()
+
+    results = asyncio.run(scenario())
+    assert chat_session.mcp_sessions == {}
+    assert app.cl.user_session.get("mcp_tool_index")["lookup"][0] == "shared"
+    assert [result["output"] for result in results] == [f"item {i}: ".ljust(40, "x") for i in range(6)]
+    assert app.mcp_pool_stats["calls"] - calls_before == 6
+
+
+def test_unreachable_shared_server_fails_fast(chat_session, shared_servers, monkeypatch):
+    monkeypatch.setattr(app, "MCP_POOL_CONNECT_TIMEOUT_SECONDS", 0.2)
+    shared_servers({"down": {"url": f"http://127.0.0.1:{free_port()}/sse"}})
+
+    async def scenario():
+        pool = app.get_shared_mcp_pools()["down"]
+        try:
+            await app.attach_shared_mcp_servers()
+            return await app.execute_tool(pool.session_for("s1"), "down", "lookup", {})
+        finally:
+            await pool.close()
+
+    result_text, status = asyncio.run(scenario())
+    # Its tools are not offered, and a call reports the outage instead of hanging
+    assert app.cl.user_session.get("mcp_tool_index") in (None, {})
+    assert status == "error"
+    assert "No healthy pooled MCP connection to down" in result_text
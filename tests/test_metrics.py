@@ -0,0 +1,45 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+
+def test_label_values_are_capped(monkeypatch):
+    monkeypatch.setattr(app, "METRICS_MAX_LABEL_VALUES", 3)
+    monkeypatch.setattr(app, "_metric_label_values", {})
+    histogram = app.Histogram("test_tool_seconds", "test")
+    for i in range(10):
+        histogram.observe(0.1, connection="srv", tool=f"tool_{i}")
+
+    assert {dict(key)["tool"] for key in histogram.series} == {"tool_0", "tool_1", "tool_2", "other"}
+    assert histogram.series[(("connection", "srv"), ("tool", "other"))][2] == 7
+
+
+def test_label_values_are_cleaned(monkeypatch):
+    monkeypatch.setattr(app, "_metric_label_values", {})
+    counter = app.Counter("test_total", "test")
+    counter.inc(model='evil"}\nmodel{x="1' + "a" * 100)
+    (key,) = counter.values
+    assert dict(key)["model"] == "evil___model_x__1" + "a" * 47
+    assert "\n" not in "\n".join(counter.render()[2:])
+
+
+def test_metrics_require_the_token_when_set(monkeypatch):
+    monkeypatch.setattr(app, "METRICS_TOKEN", "secret")
+
+    def scrape(authorization):
+        request = SimpleNamespace(headers={"authorization": authorization} if authorization else {})
+        return asyncio.run(app.metrics_endpoint(request)).status_code
+
+    assert scrape(None) == 401
+    assert scrape("Bearer wrong") == 401
+    assert scrape("Bearer secret") == 200
+
+
+@pytest.mark.skipif("METRICS_ENABLED" in os.environ, reason="METRICS_ENABLED is set")
+def test_metrics_endpoint_is_off_by_default():
+    assert app.METRICS_ENABLED is False
+    assert app.METRICS_PATH not in {getattr(route, "path", None) for route in app.chainlit_server.router.routes}
@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+import httpx
+import openai
+import pytest
+
+import app
+import stub_openrouter
+from common import start_server
+from conftest import free_port
+
+GOOD, LIMITED, BROKEN, SLOW = "stub/good", "stub/rate-limited", "stub/broken", "stub/slow"
+# Two real entries from the dropdown, so the catalog can filter it
+CATALOG_MODELS = app.OPENROUTER_MODELS[1:3]
+
+
+@pytest.fixture(scope="module")
+def openrouter_url():
+    port = free_port()
+    process = start_server(
+        stub_openrouter.serve, port, tokens=3, token_delay_ms=0,
+        models=[GOOD, LIMITED, BROKEN, SLOW, *CATALOG_MODELS],
+        model_status={LIMITED: 429, BROKEN: 503},
+        first_chunk_delay_ms={SLOW: 5000},
+    )
+    yield f"http://127.0.0.1:{port}"
+    process.terminate()
+    process.join()
+
+
+@pytest.fixture(autouse=True)
+def model_health(monkeypatch):
+    monkeypatch.setattr(app, "model_health", {})
+    return app.model_health
+
+
+async def stream_text(openrouter_url, models, max_retries=2):
+    """Open a stream through open_model_stream and return the model used and its text"""
+    client = openai.AsyncOpenAI(base_url=openrouter_url, api_key="test", max_retries=max_retries)
+    api_args = {"messages": [{"role": "user", "content": "hi"}], "stream": True}
+    try:
+        model, _, first_chunk, chunks = await app.open_model_stream(client, api_args, models)
+        text = ""
+        async for chunk in app.chain_chunks(first_chunk, chunks):
+            if chunk.choices and chunk.choices[0].delta.content:
+                text += chunk.choices[0].delta.content
+        return model, text
+    finally:
+        await client.close()
+
+
+@pytest.mark.parametrize("failing", [LIMITED, BROKEN])
+def test_falls_back_on_429_and_5xx(openrouter_url, failing):
+    model, text = asyncio.run(stream_text(openrouter_url, [failing, GOOD]))
+    assert model == GOOD
+    assert text == "tok0 tok1 tok2 "
+    assert app.model_error_rate(failing) > 0
+    assert app.model_error_rate(GOOD) == 0
+    assert app.model_health[GOOD]["ttft"] is not None
+
+
+def test_falls_back_when_the_first_chunk_is_late(openrouter_url, monkeypatch):
+    monkeypatch.setattr(app, "LLM_FIRST_CHUNK_TIMEOUT_SECONDS", 0.3)
+    started = time.monotonic()
+    model, _ = asyncio.run(stream_text(openrouter_url, [SLOW, GOOD]))
+    assert model == GOOD
+    assert time.monotonic() - started < 3
+    assert app.model_error_rate(SLOW) > 0
+
+
+def test_last_model_error_is_raised(openrouter_url):
+    with pytest.raises(openai.RateLimitError):
+        asyncio.run(stream_text(openrouter_url, [LIMITED], max_retries=0))
+
+
+def test_fastest_routing_orders_healthy_models_by_ttft(monkeypatch):
+    monkeypatch.setattr(app, "MODEL_ROUTING", "fastest")
+    monkeypatch.setattr(app, "MODEL_ROUTING_CANDIDATES", ["a", "b", "c", "d"])
+    monkeypatch.setattr(app, "MODEL_FALLBACK", "fallback")
+    app.record_model_result("a", ttft=0.5)
+    app.record_model_result("b", ttft=0.1)
+    for _ in range(10):
+        app.record_model_result("d", error=True)
+
+    # c has no samples yet and d is failing, so c goes after the measured models and d is skipped
+    assert app.plan_models("c") == ["b", "a", "c", "fallback"]
+
+
+def test_selected_routing_keeps_the_chosen_model_first(monkeypatch):
+    monkeypatch.setattr(app, "MODEL_ROUTING", "selected")
+    monkeypatch.setattr(app, "MODEL_FALLBACK", "fallback")
+    app.record_model_result("fallback", ttft=0.01)
+    assert app.plan_models("chosen") == ["chosen", "fallback"]
+    assert app.plan_models("fallback") == ["fallback"]
+
+
+def test_error_rate_decays_by_half_life(monkeypatch, model_health):
+    monkeypatch.setattr(app, "MODEL_ERROR_HALF_LIFE_SECONDS", 60)
+    app.record_model_result("m", error=True)
+    rate = app.model_error_rate("m")
+    updated_at = model_health["m"]["updated_at"]
+
+    assert rate == pytest.approx(app.MODEL_HEALTH_ALPHA)
+    assert app.model_error_rate("m", updated_at + 60) == pytest.approx(rate / 2)
+    assert app.model_error_rate("m", updated_at + 600) < app.MODEL_MAX_ERROR_RATE / 100
+
+
+def test_catalog_limits_the_offered_models(openrouter_url, monkeypatch):
+    for name in ("model_catalog", "AVAILABLE_MODELS", "OPENROUTER_MODEL_INDEX"):
+        monkeypatch.setattr(app, name, getattr(app, name))
+    catalog_data = httpx.get(f"{openrouter_url}/models").json()
+
+    try:
+        app.apply_model_catalog(catalog_data)
+        assert app.AVAILABLE_MODELS == CATALOG_MODELS
+        assert app.OPENROUTER_MODEL_INDEX == {model: index for index, model in enumerate(CATALOG_MODELS)}
+        assert GOOD in app.model_catalog
+
+        # A catalog that lists none of the dropdown models leaves the dropdown as it is
+        app.apply_model_catalog({"data": [{"id": GOOD}]})
+        assert app.AVAILABLE_MODELS == app.OPENROUTER_MODELS
+    finally:
+        # apply_model_catalog drops the prebuilt default panel along with the rest
+        app.build_settings_widgets.cache_clear()
+        app.build_settings_widgets(0, app.DEFAULT_TEMPERATURE, False, app.DEFAULT_STREAM_FLUSH_MS)
@@ -0,0 +1,97 @@
+import asyncio
+import contextlib
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import app
+import chainlit as cl
+
+
+def make_tools(count):
+    return tuple(
+        app.mcp_to_openai_tool({
+            "name": f"tool_{i}",
+            "description": f"Tool number {i} for widgets" if i % 2 else f"Tool number {i} for gadgets",
+            "input_schema": {"type": "object", "properties": {"b": {"type": "string"}, "a": {"type": "integer"}}},
+        })
+        for i in range(count)
+    )
+
+
+def serialized(messages):
+    return [json.dumps(message, sort_keys=True) for message in messages]
+
+
+def test_cache_breakpoints_only_move_the_last_message():
+    model = "anthropic/claude-sonnet-4"
+    history = [
+        {"role": "user", "content": "list the tables"},
+        {"role": "assistant", "content": "", "tool_calls": [{"id": "c1", "function": {"name": "t", "arguments": "{}"}}]},
+        {"role": "tool", "tool_call_id": "c1", "name": "t", "content": "orders, products"},
+    ]
+    before = serialized(app.build_api_messages(model, history[:2]))
+    after = serialized(app.build_api_messages(model, history))
+
+    # The system prompt and every message before the previous breakpoint are byte-identical
+    assert before[:-1] == after[:-2]
+    assert json.loads(after[-1])["content"][0]["cache_control"] == {"type": "ephemeral"}
+    # The history itself is left untouched
+    assert history[-1]["content"] == "orders, products"
+
+
+def test_tools_payload_is_byte_stable(chat_session):
+    tools = make_tools(6)
+    first = app.refresh_tools_payload({"a": tools[:3], "b": tools[3:]})
+    second = app.refresh_tools_payload({"b": tools[3:], "a": tools[:3]})
+    assert json.dumps(first["tools"]) == json.dumps(second["tools"])
+    assert second["version"] == first["version"] + 1
+
+
+def test_tool_selection_is_stable_within_a_message(chat_session):
+    payload = app.refresh_tools_payload({"a": make_tools(app.TOOL_SELECTION_MIN_TOOLS + 10)})
+    first = app.select_tools(payload, [{"role": "user", "content": "find widgets"}])
+    assert first is not None
+
+    # Tool-loop iterations of the same message keep the subset even as the context shifts
+    assert app.select_tools(payload, [{"role": "user", "content": "find gadgets"}]) == first
+
+    # The next user message chooses again
+    cl.user_session.set("tool_selection", None)
+    assert app.select_tools(payload, [{"role": "user", "content": "find gadgets"}]) != first
+
+
+class RequestCaptured(Exception):
+    pass
+
+
+def test_default_model_gets_a_tool_subset(chat_session, monkeypatch):
+    # The default model also takes prompt-cache breakpoints; it still gets the selected subset
+    app.refresh_tools_payload({"a": make_tools(app.TOOL_SELECTION_MIN_TOOLS + 10)})
+    cl.user_session.set("settings", {"Model": app.DEFAULT_MODEL})
+    requests = []
+
+    async def create(**api_args):
+        requests.append(api_args)
+        raise RequestCaptured
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    client.with_options = lambda **options: client
+
+    @contextlib.asynccontextmanager
+    async def use_client(api_key):
+        yield client
+
+    monkeypatch.setattr(app, "use_openai_client", use_client)
+    with pytest.raises(RequestCaptured):
+        asyncio.run(app.call_llm([{"role": "user", "content": "find widgets"}], "sk-test"))
+    assert requests[0]["model"] == app.DEFAULT_MODEL
+    assert len(requests[0]["tools"]) == app.TOOL_SELECTION_TOP_K
+
+
+def test_unmatched_context_sends_every_tool(chat_session):
+    payload = app.refresh_tools_payload({"a": make_tools(app.TOOL_SELECTION_MIN_TOOLS + 10)})
+    assert app.select_tools(payload, [{"role": "user", "content": "hello there"}]) is None
+    # The empty choice is kept for the rest of the message too
+    assert app.select_tools(payload, [{"role": "user", "content": "find widgets"}]) is None
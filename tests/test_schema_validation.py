@@ -0,0 +1,54 @@
+import app
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "query": {"type": "string"},
+        "limit": {"type": "integer"},
+        "mode": {"enum": ["fast", "full"]},
+        "tags": {"type": "array", "items": {"type": "string"}},
+        "filter": {
+            "type": "object",
+            "properties": {"score": {"type": ["number", "null"]}},
+            "required": ["score"],
+        },
+    },
+    "required": ["query"],
+    "additionalProperties": False,
+}
+
+
+def test_valid_arguments_pass():
+    validate = app.compile_schema(SCHEMA)
+    assert validate({"query": "x", "limit": 3, "mode": "fast", "tags": ["a"], "filter": {"score": None}}) == []
+
+
+def test_errors_name_the_offending_path():
+    validate = app.compile_schema(SCHEMA)
+    errors = validate({"limit": "3", "mode": "slow", "tags": ["a", 1], "filter": {}, "extra": 1})
+    assert errors == [
+        "$: missing required property 'query'",
+        "$.limit: expected integer, got str",
+        "$.mode: must be one of ['fast', 'full']",
+        "$.tags[1]: expected string, got int",
+        "$.filter: missing required property 'score'",
+        "$: unexpected property 'extra'",
+    ]
+
+
+def test_type_mismatch_skips_the_remaining_checks():
+    validate = app.compile_schema(SCHEMA)
+    assert validate(["query"]) == ["$: expected object, got list"]
+
+
+def test_integer_rules_follow_json_not_python():
+    validate = app.compile_schema({"type": "integer"})
+    assert validate(True) == ["$: expected integer, got bool"]
+    assert validate(2.0) == []
+    assert validate(2.5) == ["$: expected integer, got float"]
+    assert app.compile_schema({"type": "number"})(False) == ["$: expected number, got bool"]
+
+
+def test_unchecked_keywords_and_missing_schema_accept_anything():
+    assert app.compile_schema({"pattern": "^a$", "minLength": 3})("b") == []
+    assert app.compile_schema(None)({"anything": 1}) == []
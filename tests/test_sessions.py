@@ -0,0 +1,81 @@
+import asyncio
+import gc
+import uuid
+import weakref
+
+import pytest
+from chainlit.context import ChainlitContext, context_var
+from chainlit.session import WebsocketSession
+from chainlit.user_session import user_sessions
+from starlette.applications import Starlette
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+import app
+from conftest import _noop_emit
+
+SOAK_SESSIONS = 3000
+
+
+@pytest.fixture
+def admin_client(monkeypatch):
+    monkeypatch.setattr(app, "ADMIN_TOKEN", "secret")
+    client = TestClient(Starlette(routes=[Route("/admin/sessions", app.admin_sessions_endpoint)]))
+    client.headers["authorization"] = "Bearer secret"
+    return client
+
+
+@pytest.mark.parametrize("limit, status", [("5", 200), ("-1", 200), ("abc", 400), ("", 400)])
+def test_admin_sessions_limit_is_validated(admin_client, limit, status):
+    response = admin_client.get("/admin/sessions", params={"limit": limit})
+    assert response.status_code == status
+    if status == 200:
+        assert len(response.json()["largest"]) <= max(0, int(limit))
+
+
+# Every message Chainlit sends warns about utcnow in literalai
+@pytest.mark.filterwarnings("ignore::DeprecationWarning")
+def test_abandoned_sessions_leave_nothing_behind(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "SESSION_SWEEP_INTERVAL_SECONDS", 0)
+    monkeypatch.setattr(app, "MODEL_CATALOG_REFRESH_SECONDS", 0)
+    monkeypatch.setattr(app, "USER_SETTINGS_CACHE_SIZE", 100)
+    monkeypatch.setattr(app, "settings_backend", app.JsonSettingsBackend(str(tmp_path)))
+    monkeypatch.setattr(app, "_user_settings_cache", app.OrderedDict())
+    monkeypatch.setattr(app, "_session_activity", {})
+    monkeypatch.setattr(app, "session_lifecycle_stats", {"evicted": 0, "ended": 0, "trimmed_messages": 0})
+    sessions = weakref.WeakSet()
+
+    async def open_and_abandon(i):
+        session = WebsocketSession(
+            id=str(uuid.uuid4()), socket_id=str(uuid.uuid4()), emit=_noop_emit, emit_call=_noop_emit,
+            user_env={"OPENROUTER_API_KEY": f"key-{i}"}, client_type="webapp", thread_id=str(uuid.uuid4()),
+        )
+        sessions.add(session)
+        token = context_var.set(ChainlitContext(session))
+        try:
+            await app.start_chat()
+            app.cl.user_session.set("chat_messages", [{"role": "user", "content": f"question {i}"}])
+            # Half the users close the chat, the rest just go away and Chainlit times them out
+            session.to_clear = i % 2 == 0
+            await app.on_chat_end()
+        finally:
+            context_var.reset(token)
+        user_sessions.pop(session.id, None)
+        await session.delete()
+
+    async def soak():
+        for i in range(SOAK_SESSIONS):
+            await open_and_abandon(i)
+        assert len(app._session_activity) == SOAK_SESSIONS // 2
+        monkeypatch.setattr(app, "SESSION_SWEEP_INTERVAL_SECONDS", 0.01)
+        sweeper = asyncio.create_task(app.sweep_idle_sessions())
+        await asyncio.sleep(0.1)
+        sweeper.cancel()
+
+    asyncio.run(soak())
+    gc.collect()
+
+    assert app._session_activity == {}
+    assert app.session_lifecycle_stats["ended"] == SOAK_SESSIONS
+    assert len(app._user_settings_cache) <= 100
+    assert len(sessions) == 0
@@ -0,0 +1,77 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import app
+from conftest import APP_ROOT
+
+
+# Time the app may add to startup beyond chainlit itself; it takes about 100ms today,
+# while importing the OpenAI SDK eagerly would add most of a second
+IMPORT_TIME_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "400"))
+
+
+def import_app():
+    """Import the app in a fresh interpreter with -X importtime.
+
+    Returns (depth, cumulative microseconds, module name) rows in the order Python
+    reports them, where a module follows the modules it imported.
+    """
+    env = {**os.environ, "PYTHONPATH": APP_ROOT, "CHAINLIT_APP_ROOT": APP_ROOT}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=APP_ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        name = name[1:]
+        rows.append(((len(name) - len(name.lstrip())) // 2, int(cumulative), name.strip()))
+    return rows
+
+
+def app_import_ms(rows):
+    """Cumulative import time of the app minus the chainlit modules it imports directly"""
+    index = [name for _, _, name in rows].index("app")
+    chainlit_us = 0
+    for depth, cumulative, name in reversed(rows[:index]):
+        if depth == 0:
+            break
+        if depth == 1 and name.split(".")[0] == "chainlit":
+            chainlit_us += cumulative
+    return (rows[index][1] - chainlit_us) / 1000
+
+
+def test_openai_sdk_is_not_imported_at_startup():
+    modules = {name for _, _, name in import_app()}
+    assert "app" in modules
+    assert not {name for name in modules if name == "openai" or name.startswith("openai.")}
+
+
+def test_app_import_time_stays_within_budget():
+    # Best of two runs, so a busy machine does not fail the check on its own
+    elapsed_ms = min(app_import_ms(import_app()) for _ in range(2))
+    assert elapsed_ms < IMPORT_TIME_BUDGET_MS, f"app adds {elapsed_ms:.0f}ms to startup"
+
+
+def test_openai_sdk_is_preloaded_off_the_event_loop(monkeypatch):
+    imports = []
+    monkeypatch.setattr(app, "_openai_import", None)
+    monkeypatch.setattr(app.importlib, "import_module", lambda name: imports.append(name))
+
+    async def preload_twice():
+        first = app.preload_openai()
+        assert app.preload_openai() is first
+        await first
+
+    asyncio.run(preload_twice())
+    assert imports == ["openai"]
+
+
+def test_default_settings_panel_is_prebuilt():
+    before = app.build_settings_widgets.cache_info().hits
+    app.build_settings_widgets(0, app.DEFAULT_TEMPERATURE, False, app.DEFAULT_STREAM_FLUSH_MS)
+    assert app.build_settings_widgets.cache_info().hits == before + 1
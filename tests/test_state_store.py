@@ -0,0 +1,125 @@
+import asyncio
+import json
+
+import pytest
+
+import app
+from fake_redis import FakeRedisServer
+from conftest import free_port
+
+
+@pytest.fixture
+def redis_url():
+    pytest.importorskip("redis")
+    server = FakeRedisServer()
+    yield server.start()
+    server.stop()
+
+
+def test_pack_state_round_trip():
+    value = {"role": "tool", "content": "ok", "tool_calls": [{"id": "c1"}], "n": 3}
+    assert app.unpack_state(app.pack_state(value)) == value
+
+
+def test_memory_store_appends_and_reads():
+    store = app.MemoryStateStore(ttl=60)
+
+    async def scenario():
+        await store.append("chat:t:messages", [{"role": "user", "content": "hi"}])
+        await store.append("chat:t:messages", [{"role": "assistant", "content": "hello"}])
+        await store.set("chat:t:settings", {"Model": "m"})
+        return await store.load_list("chat:t:messages"), await store.get("chat:t:settings")
+
+    messages, settings = asyncio.run(scenario())
+    assert [m["content"] for m in messages] == ["hi", "hello"]
+    assert settings == {"Model": "m"}
+
+
+def test_memory_store_expires_keys(monkeypatch):
+    store = app.MemoryStateStore(ttl=60)
+    now = app.time.monotonic()
+    asyncio.run(store.append("old", [1]))
+    asyncio.run(store.set("old_value", 1))
+
+    monkeypatch.setattr(app.time, "monotonic", lambda: now + 120)
+    assert asyncio.run(store.load_list("old")) == []
+    # Any write sweeps keys that expired without being read again
+    asyncio.run(store.set("new", 2))
+    assert "old_value" not in store.values
+    assert asyncio.run(store.get("new")) == 2
+
+
+def test_state_carries_its_format(monkeypatch):
+    value = {"Model": "m", "Temperature": 0.5}
+    monkeypatch.setattr(app, "STATE_SERIALIZATION", "json")
+    as_json = app.pack_state(value)
+    monkeypatch.setattr(app, "STATE_SERIALIZATION", "msgpack")
+    as_msgpack = app.pack_state(value)
+    assert as_json[:1] == app.STATE_FORMAT_JSON
+    # A replica reads either format, whichever it writes
+    assert app.unpack_state(as_json) == app.unpack_state(as_msgpack) == value
+    if app.msgpack is not None:
+        assert as_msgpack[:1] == app.STATE_FORMAT_MSGPACK
+
+
+def test_state_written_before_the_format_byte_is_read():
+    value = {"role": "user", "content": "hi"}
+    assert app.unpack_state(json.dumps(value).encode()) == value
+    if app.msgpack is not None:
+        assert app.unpack_state(app.msgpack.packb(value, use_bin_type=True)) == value
+
+
+def test_unreadable_state_raises_value_error(monkeypatch):
+    monkeypatch.setattr(app, "msgpack", None)
+    with pytest.raises(ValueError):
+        app.unpack_state(app.STATE_FORMAT_MSGPACK + b"\x81\xa1a\x01")
+    with pytest.raises(ValueError):
+        app.unpack_state(b"not json")
+
+
+def test_redis_store_appends_only_new_messages(redis_url):
+    store = app.RedisStateStore(redis_url)
+
+    async def scenario():
+        await store.append("chat:t:messages", [{"role": "user", "content": "hi"}])
+        await store.append("chat:t:messages", [{"role": "assistant", "content": "hello"}, {"role": "user", "content": "?"}])
+        await store.set("chat:t:settings", {"Model": "m"})
+        messages = await store.load_list("chat:t:messages")
+        settings = await store.get("chat:t:settings")
+        ttl = await store.client.ttl("chat:t:messages")
+        raw = await store.client.lrange("chat:t:messages", 0, -1)
+        await store.delete("chat:t:settings")
+        deleted = await store.get("chat:t:settings")
+        await store.client.aclose()
+        return messages, settings, ttl, raw, deleted
+
+    messages, settings, ttl, raw, deleted = asyncio.run(scenario())
+    assert [m["content"] for m in messages] == ["hi", "hello", "?"]
+    assert settings == {"Model": "m"}
+    assert 0 < ttl <= app.STATE_TTL_SECONDS
+    # Each message is its own list entry, written once
+    assert len(raw) == 3 and all(item[:1] in (app.STATE_FORMAT_JSON, app.STATE_FORMAT_MSGPACK) for item in raw)
+    assert deleted is None
+
+
+def test_redis_settings_backend_round_trip(redis_url):
+    backend = app.RedisSettingsBackend(redis_url)
+    backend.save_many({"a": {"Model": "x"}, "b": {"Model": "y"}})
+    assert backend.load("a") == {"Model": "x"}
+    assert backend.load("missing") is None
+
+
+def test_unreachable_redis_does_not_break_chat_start(chat_session, monkeypatch):
+    pytest.importorskip("redis")
+    monkeypatch.setattr(app, "settings_backend", app.RedisSettingsBackend(f"redis://127.0.0.1:{free_port()}/0"))
+    monkeypatch.setattr(app, "state_store", app.RedisStateStore(f"redis://127.0.0.1:{free_port()}/0"))
+    monkeypatch.setattr(app, "_user_settings_cache", app.OrderedDict())
+
+    async def scenario():
+        settings = await app.load_user_settings("u")
+        await app.restore_chat_state()
+        await app.persist_chat_messages([{"role": "user", "content": "hi"}])
+        return settings
+
+    assert asyncio.run(scenario()) is None
+    assert app.cl.user_session.get("persisted_messages", 0) == 0
@@ -0,0 +1,39 @@
+import asyncio
+
+import app
+
+
+class FakeMessage:
+    def __init__(self):
+        self.frames = []
+
+    async def stream_token(self, token):
+        self.frames.append(token)
+
+
+def test_tokens_are_coalesced_until_the_size_threshold():
+    msg = FakeMessage()
+    writer = app.CoalescingStreamWriter(msg, flush_ms=60_000, flush_chars=10)
+
+    async def scenario():
+        for token in ["ab", "cd", "ef", "gh", "ij", "kl"]:
+            await writer.write(token)
+        await writer.flush()
+
+    asyncio.run(scenario())
+    assert msg.frames == ["abcdefghij", "kl"]
+    assert writer.text() == "abcdefghijkl"
+    assert writer.emits == 2
+
+
+def test_zero_interval_sends_every_token():
+    msg = FakeMessage()
+    writer = app.CoalescingStreamWriter(msg, flush_ms=0, flush_chars=1000)
+
+    async def scenario():
+        for token in ["a", "b", "c"]:
+            await writer.write(token)
+        await writer.flush()
+
+    asyncio.run(scenario())
+    assert msg.frames == ["a", "b", "c"]
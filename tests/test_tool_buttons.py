@@ -0,0 +1,70 @@
+import asyncio
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+import app
+import chainlit as cl
+from chainlit.config import config
+from chainlit.context import ChainlitContext, context_var
+from chainlit.session import WebsocketSession
+from chainlit.user_session import user_sessions
+
+from conftest import _noop_emit
+
+
+class FakeMcpSession:
+    def __init__(self, prefix, count):
+        self.tools = [
+            SimpleNamespace(
+                name=f"{prefix}_{i}",
+                description="",
+                inputSchema={"type": "object", "properties": {"n": {"type": "integer", "default": i}}},
+                annotations=None,
+            )
+            for i in range(count)
+        ]
+
+    async def list_tools(self):
+        return SimpleNamespace(tools=self.tools)
+
+
+def test_tool_buttons_share_one_callback(chat_session):
+    registered = sorted(config.code.action_callbacks)
+    cl.user_session.set("settings", {"CreateToolButtons": True})
+
+    async def scenario():
+        for name in ("first", "second"):
+            connection = SimpleNamespace(name=name, url=f"http://{name}/sse", headers={})
+            await app.on_mcp(connection, FakeMcpSession(name, 5))
+
+    asyncio.run(scenario())
+    assert sorted(config.code.action_callbacks) == registered == sorted(["action_button", "list_tools", app.TOOL_ACTION_NAME])
+    assert len(cl.user_session.get("mcp_tool_index")) == 10
+
+
+# Every message Chainlit sends warns about utcnow in literalai
+@pytest.mark.filterwarnings("ignore::DeprecationWarning")
+def test_callback_registry_stays_constant_across_sessions():
+    registered = dict(config.code.action_callbacks)
+
+    async def scenario():
+        for i in range(1000):
+            session = WebsocketSession(
+                id=str(uuid.uuid4()), socket_id=str(uuid.uuid4()), emit=_noop_emit, emit_call=_noop_emit,
+                user_env={}, client_type="webapp", thread_id=str(uuid.uuid4()),
+            )
+            token = context_var.set(ChainlitContext(session))
+            try:
+                cl.user_session.set("settings", {"CreateToolButtons": True})
+                connection = SimpleNamespace(name=f"server_{i}", url=f"http://server_{i}/sse", headers={})
+                await app.on_mcp(connection, FakeMcpSession(f"session_{i}", 3))
+                assert config.code.action_callbacks == registered
+            finally:
+                context_var.reset(token)
+                user_sessions.pop(session.id, None)
+                await session.delete()
+
+    asyncio.run(scenario())
+    assert config.code.action_callbacks == registered
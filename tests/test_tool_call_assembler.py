@@ -0,0 +1,91 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import chainlit as cl
+
+import app
+import stub_openrouter
+from common import start_server
+from conftest import free_port
+
+
+def fragment(index, arguments=None, name=None, call_id=None):
+    return SimpleNamespace(index=index, id=call_id, function=SimpleNamespace(name=name, arguments=arguments))
+
+
+def test_call_is_dispatched_when_its_object_closes():
+    completed = []
+    assembler = app.ToolCallAssembler(on_complete=completed.append)
+    assembler.add(fragment(0, name="read_query", call_id="c1"))
+    assembler.add(fragment(0, '{"sql": "select \'}\' from t'))
+    assembler.add(fragment(0, ' where x = \\"{\\"'))
+    assert completed == []
+    assembler.add(fragment(0, '", "limit": {"n": 1}}'))
+
+    assert len(completed) == 1
+    assert json.loads(completed[0]["function"]["arguments"]) == {
+        "sql": "select '}' from t where x = \"{\"", "limit": {"n": 1},
+    }
+
+
+def test_next_call_completes_the_previous_one():
+    completed = []
+    assembler = app.ToolCallAssembler(on_complete=completed.append)
+    assembler.add(fragment(0, '{"a": ', name="first", call_id="c1"))
+    assembler.add(fragment(1, '{"b": 2}', name="second", call_id="c2"))
+    assert [call["function"]["name"] for call in completed] == ["first", "second"]
+
+    calls = assembler.finish()
+    assert [call["id"] for call in calls] == ["c1", "c2"]
+    assert len(completed) == 2
+
+
+def test_arguments_are_parsed_once(monkeypatch):
+    parses = []
+    real_loads = json.loads
+    monkeypatch.setattr(app.json, "loads", lambda text: parses.append(text) or real_loads(text))
+
+    assembler = app.ToolCallAssembler()
+    assembler.add(fragment(0, '{"items": "', name="t", call_id="c1"))
+    for _ in range(1000):
+        assembler.add(fragment(0, "}{},"))
+    assembler.add(fragment(0, '"}'))
+    assert len(parses) == 1
+    assert assembler.completed == [True]
+
+
+def test_calls_are_dispatched_while_the_stream_continues(chat_session, monkeypatch):
+    port = free_port()
+    # Each call streams as three fragments, 50ms apart
+    server = start_server(stub_openrouter.serve, port, tokens=0, token_delay_ms=50, tool_calls=3, tool_name="lookup")
+    monkeypatch.setattr(app, "OPENROUTER_BASE_URL", f"http://127.0.0.1:{port}")
+    monkeypatch.setattr(app, "_openai_clients", OrderedDict())
+    monkeypatch.setattr(app, "model_health", {})
+    app.refresh_tools_payload({"stub": (app.mcp_to_openai_tool({
+        "name": "lookup", "description": "Look up an item",
+        "input_schema": {"type": "object", "properties": {"query": {"type": "string"}}},
+    }),)})
+    cl.user_session.set("settings", {"Model": "stub/model"})
+    dispatched = []
+
+    async def turn():
+        message = await app.call_llm(
+            [{"role": "user", "content": "look up three items"}], "sk-test",
+            dispatch_tool=lambda call: dispatched.append((time.monotonic(), call)),
+        )
+        return message, time.monotonic()
+
+    try:
+        message, finished = asyncio.run(turn())
+    finally:
+        server.terminate()
+        server.join()
+
+    calls = [call for _, call in dispatched]
+    assert calls == message["tool_calls"]
+    assert [json.loads(call["function"]["arguments"]) for call in calls] == [{"query": f"item {i}"} for i in range(3)]
+    # The first call went out while six more fragments were still to come
+    assert finished - dispatched[0][0] >= 0.2
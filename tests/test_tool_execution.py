@@ -0,0 +1,69 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from chainlit.step import Step
+
+import app
+
+
+class FakeMcpSession:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+
+    async def call_tool(self, tool_name, arguments):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        return SimpleNamespace(content=[SimpleNamespace(text=f"{tool_name} done")], isError=False)
+
+
+def test_calls_per_connection_are_bounded(chat_session, monkeypatch):
+    monkeypatch.setattr(app, "MAX_CONCURRENT_TOOL_CALLS_PER_CONNECTION", 2)
+    mcp_session = FakeMcpSession(delay=0.01)
+
+    async def scenario():
+        return await asyncio.gather(*(app.execute_tool(mcp_session, "srv", "lookup", {}) for _ in range(6)))
+
+    results = asyncio.run(scenario())
+    assert results == [("lookup done", "ok")] * 6
+    assert mcp_session.max_active == 2
+
+
+def test_slow_call_times_out(chat_session, monkeypatch):
+    monkeypatch.setattr(app, "TOOL_CALL_TIMEOUTS", {"slow": 0.01})
+    result_text, status = asyncio.run(app.execute_tool(FakeMcpSession(delay=1), "srv", "slow", {}))
+    assert status == "timeout"
+    assert json.loads(result_text) == {"error": "timeout", "tool": "slow", "timeout_seconds": 0.01}
+
+
+
+def test_cache_hit_is_marked_in_the_step(chat_session, monkeypatch):
+    monkeypatch.setattr(app, "TOOL_RESULT_CACHE_ENABLED", True)
+    monkeypatch.setattr(app, "TOOL_RESULT_CACHE_TOOLS", {"lookup"})
+    mcp_tools_data = {"srv": ({"name": "lookup", "description": "", "input_schema": {"type": "object"}},)}
+    app.cl.user_session.set("mcp_tools_data", mcp_tools_data)
+    app.refresh_tool_index(mcp_tools_data)
+    chat_session.mcp_sessions["srv"] = (FakeMcpSession(), None)
+    steps = []
+
+    async def record_step(step):
+        steps.append((step.name, step.output))
+    monkeypatch.setattr(Step, "update", record_step)
+
+    def lookup_call(i):
+        return app.to_tool_call({"id": f"call_{i}", "type": "function", "function": {"name": "lookup", "arguments": "{}"}})
+
+    async def scenario():
+        return [await app.call_tool(lookup_call(i)) for i in range(2)]
+
+    first, second = asyncio.run(scenario())
+    assert first["output"] == second["output"] == "lookup done"
+    assert steps[-2][0] == "lookup"
+    assert "cached" not in steps[-2][1]
+    assert steps[-1] == ("lookup (cached)", "(cached result)\nlookup done")
@@ -0,0 +1,51 @@
+import asyncio
+from types import SimpleNamespace
+
+import app
+
+
+def raw_tool(name, description=""):
+    return {"name": name, "description": description, "input_schema": {"type": "object"}}
+
+
+def test_first_connection_owns_a_duplicate_tool_name(chat_session):
+    mcp_tools_data = {
+        "first": (raw_tool("query", "first"), raw_tool("only_first")),
+        "second": (raw_tool("query", "second"),),
+    }
+    tool_index, collisions = app.build_tool_index(mcp_tools_data)
+    assert tool_index["query"][0] == "first"
+    assert collisions == {"query": ["first", "second"]}
+
+    payload = app.refresh_tools_payload({
+        name: tuple(app.mcp_to_openai_tool(tool) for tool in tools) for name, tools in mcp_tools_data.items()
+    })
+    sent = [tool["function"] for tool in payload["tools"]]
+    assert [function["name"] for function in sent] == ["only_first", "query"]
+    assert sent[1]["description"] == "first"
+
+
+class FakeMcpSession:
+    def __init__(self, name):
+        self.name = name
+        self.calls = []
+
+    async def call_tool(self, tool_name, arguments):
+        self.calls.append((tool_name, arguments))
+        return SimpleNamespace(content=[SimpleNamespace(text=f"{tool_name} on {self.name}")], isError=False)
+
+
+def test_tool_button_runs_on_its_own_connection(chat_session):
+    mcp_tools_data = {"first": (raw_tool("query"),), "second": (raw_tool("query"),)}
+    app.cl.user_session.set("mcp_tools_data", mcp_tools_data)
+    app.refresh_tool_index(mcp_tools_data)
+    sessions = {name: FakeMcpSession(name) for name in mcp_tools_data}
+    for name, session in sessions.items():
+        chat_session.mcp_sessions[name] = (session, None)
+
+    action = SimpleNamespace(name=app.TOOL_ACTION_NAME, payload={"tool_name": "query", "params": {}, "connection": "second"})
+    asyncio.run(app.handle_action(action))
+
+    assert sessions["second"].calls == [("query", {})]
+    assert sessions["first"].calls == []
+    assert app.cl.user_session.get("chat_messages")[-1]["content"] == "query on second"
@@ -0,0 +1,63 @@
+import asyncio
+import os
+import subprocess
+import sys
+from collections import OrderedDict
+
+import pytest
+
+import app
+from conftest import APP_ROOT
+
+
+@pytest.fixture
+def sqlite_settings(tmp_path, monkeypatch):
+    """A SQLite settings backend in a temporary directory with an empty cache and queue"""
+    backend = app.SqliteSettingsBackend(str(tmp_path / "settings.db"))
+    monkeypatch.setattr(app, "settings_backend", backend)
+    monkeypatch.setattr(app, "_user_settings_cache", OrderedDict())
+    monkeypatch.setattr(app, "_pending_user_settings", {})
+    monkeypatch.setattr(app, "_settings_flush_task", None)
+    return backend
+
+
+def test_import_writes_no_settings_files(tmp_path):
+    env = {**os.environ, "PYTHONPATH": APP_ROOT, "CHAINLIT_APP_ROOT": APP_ROOT}
+    subprocess.run([sys.executable, "-c", "import app"], cwd=tmp_path, env=env, check=True, capture_output=True)
+    assert not (tmp_path / "user_settings").exists()
+    assert not (tmp_path / "user_settings.db").exists()
+
+
+def test_cache_is_bounded(sqlite_settings, monkeypatch):
+    monkeypatch.setattr(app, "USER_SETTINGS_CACHE_SIZE", 2)
+    for user_id in ("a", "b", "c"):
+        app.cache_user_settings(user_id, {"Model": user_id})
+    assert list(app._user_settings_cache) == ["b", "c"]
+
+
+def test_writes_from_another_replica_show_up_after_the_ttl(sqlite_settings, monkeypatch):
+    sqlite_settings.save_many({"u": {"Model": "first"}})
+    assert asyncio.run(app.load_user_settings("u")) == {"Model": "first"}
+
+    # Another replica writes to the shared backend
+    sqlite_settings.save_many({"u": {"Model": "second"}})
+    assert asyncio.run(app.load_user_settings("u")) == {"Model": "first"}
+
+    now = app.time.monotonic()
+    monkeypatch.setattr(app.time, "monotonic", lambda: now + app.USER_SETTINGS_CACHE_TTL_SECONDS + 1)
+    assert asyncio.run(app.load_user_settings("u")) == {"Model": "second"}
+
+
+def test_queued_settings_are_written_on_shutdown(sqlite_settings, monkeypatch):
+    monkeypatch.setattr(app, "USER_SETTINGS_WRITE_DELAY_SECONDS", 3600)
+
+    async def scenario():
+        app.save_user_settings("u", {"Model": "m"})
+        # Read back before the write: the queued copy wins
+        assert (await app.load_user_settings("u"))["Model"] == "m"
+        assert sqlite_settings.load("u") is None
+        await app.on_app_shutdown()
+
+    asyncio.run(scenario())
+    assert sqlite_settings.load("u")["Model"] == "m"
+    assert app._pending_user_settings == {}